@@ -15,6 +15,7 @@ import requests
 import json
 import random
 import warnings
+import threading
 import urlparse
 import psycopg2
 import psycopg2.extras # needed though you wouldn't guess it
@@ -112,31 +113,41 @@ Compress(app)
 app.config["COMPRESS_DEBUG"] = compress_json
 
 
-redshift_url = urlparse.urlparse(os.getenv("DATABASE_URL_REDSHIFT"))
-app.config['postgreSQL_pool'] = ThreadedConnectionPool(2, 5,
-                                  database=redshift_url.path[1:],
-                                  user=redshift_url.username,
-                                  password=redshift_url.password,
-                                  host=redshift_url.hostname,
-                                  port=redshift_url.port)
+db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    # opened on first use instead of at import, so booting a worker never waits on redshift
+    if not app.config.get('postgreSQL_pool'):
+        with db_pool_lock:
+            if not app.config.get('postgreSQL_pool'):
+                redshift_url = urlparse.urlparse(os.getenv("DATABASE_URL_REDSHIFT"))
+                app.config['postgreSQL_pool'] = ThreadedConnectionPool(2, 5,
+                                                  database=redshift_url.path[1:],
+                                                  user=redshift_url.username,
+                                                  password=redshift_url.password,
+                                                  host=redshift_url.hostname,
+                                                  port=redshift_url.port)
+    return app.config['postgreSQL_pool']
 
 
 @contextmanager
 def get_db_connection():
+    pool = get_db_pool()
+    connection = pool.getconn()
     try:
-        connection = app.config['postgreSQL_pool'].getconn()
         connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         connection.autocommit=True
         # connection.readonly = True
         yield connection
     finally:
-        app.config['postgreSQL_pool'].putconn(connection)
+        pool.putconn(connection)
 
 @contextmanager
-def get_db_cursor(commit=False):
+def get_db_cursor(commit=False, cursor_factory=psycopg2.extras.RealDictCursor):
+    # pass cursor_factory=None to get plain tuple rows, much lighter for big result sets
     with get_db_connection() as connection:
       cursor = connection.cursor(
-                  cursor_factory=psycopg2.extras.RealDictCursor)
+                  cursor_factory=cursor_factory)
       try:
           yield cursor
           if commit:
@@ -0,0 +1,29 @@
+# rebuilds data/jump_cache.pkl, the precomputed /jump/temp responses for the packages we have
+# run: python build_jump_cache.py
+
+import os
+import pickle
+
+# only here for get_jump_response, not to serve anything
+os.environ["WARM_UP_DATASETS"] = "False"
+os.environ["REFRESH_DATASETS"] = "False"
+
+from app import logger
+from views import get_jump_response
+from views import jump_cache_filename
+
+jump_cache_packages = ["cdl_elsevier", "mit_elsevier", "uva_elsevier"]
+
+
+def build_jump_cache_file():
+    new_jump_cache = {}
+    for package in jump_cache_packages:
+        logger.info(u"building jump cache for {}".format(package))
+        new_jump_cache[package] = get_jump_response(package)
+    with open(jump_cache_filename, "wb") as f:
+        pickle.dump(new_jump_cache, f, -1)
+    logger.info(u"wrote {}".format(jump_cache_filename))
+
+
+if __name__ == "__main__":
+    build_jump_cache_file()
@@ -0,0 +1,29 @@
+# named country groups for /metrics/geo/region
+# iso2 codes, same as country_iso2 in the oamonitor tables
+
+country_groups = {
+    "eu": {
+        "name": "European Union",
+        "countries": "AT BE BG CY CZ DE DK EE ES FI FR GR HR HU IE IT LT LU LV MT NL PL PT RO SE SI SK".split()
+    },
+    "oecd": {
+        "name": "OECD",
+        "countries": "AT AU BE CA CH CL CO CR CZ DE DK EE ES FI FR GB GR HU IE IL IS IT JP KR LT LU LV MX NL NO NZ PL PT SE SI SK TR US".split()
+    },
+    "g7": {
+        "name": "G7",
+        "countries": "CA DE FR GB IT JP US".split()
+    },
+    "g20": {
+        "name": "G20 countries",
+        "countries": "AR AU BR CA CN DE FR GB ID IN IT JP KR MX RU SA TR US ZA".split()
+    },
+    "brics": {
+        "name": "BRICS",
+        "countries": "BR CN IN RU ZA".split()
+    },
+    "nordic": {
+        "name": "Nordic countries",
+        "countries": "DK FI IS NO SE".split()
+    }
+}
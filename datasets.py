@@ -0,0 +1,234 @@
+import os
+import threading
+from time import time
+from time import sleep
+from datetime import datetime
+from collections import OrderedDict
+from sqlalchemy import sql
+
+from app import app
+from app import db
+from app import logger
+from util import elapsed
+
+
+class Dataset(object):
+    """
+    A reference table we keep in memory.
+
+    Nothing is loaded at import: the first get() loads it, or the warm-up thread
+    does it in the background right after the worker boots.  After that the refresh
+    thread rebuilds it when it is older than refresh_seconds, when its version()
+    changes, or when a dataset it depends_on has been reloaded.  The new copy is
+    built off to the side and swapped in with one assignment, so readers always
+    see a complete copy, old or new.
+
+    A lazy dataset is skipped by the warm-up thread and doesn't hold up /ready: it is
+    loaded by the first request that needs it, and refreshed like the rest after that.
+    """
+
+    def __init__(self, name, loader, refresh_seconds=None, version=None, depends_on=None, lazy=False):
+        self.name = name
+        self.loader = loader
+        self.refresh_seconds = refresh_seconds
+        self.version = version
+        self.depends_on = depends_on or []
+        self.lazy = lazy
+        self.value = None
+        self.is_loaded = False
+        self.loaded_at = None
+        self.loaded_version = None
+        self.load_seconds = None
+        self.num_loads = 0
+        self.error = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if not self.is_loaded:
+            with self._lock:
+                if not self.is_loaded:
+                    self.load()
+        return self.value
+
+    def load(self):
+        start_time = time()
+        try:
+            new_version = self.version() if self.version else None
+            new_value = self.loader()
+        except Exception as e:
+            self.error = u"{}: {}".format(e.__class__.__name__, e)
+            raise
+        self.value = new_value
+        self.loaded_version = new_version
+        self.error = None
+        self.loaded_at = time()
+        self.load_seconds = elapsed(start_time)
+        self.num_loads += 1
+        self.is_loaded = True
+        logger.info(u"loaded dataset {} in {} seconds".format(self.name, self.load_seconds))
+
+    def refresh(self):
+        with self._lock:
+            self.load()
+
+    @property
+    def age_seconds(self):
+        if not self.loaded_at:
+            return None
+        return elapsed(self.loaded_at)
+
+    def needs_refresh(self):
+        # first loads belong to get() and the warm-up thread
+        if not self.is_loaded:
+            return False
+        if self.refresh_seconds and self.age_seconds >= self.refresh_seconds:
+            return True
+        if any(dataset.loaded_at > self.loaded_at for dataset in self.depends_on if dataset.loaded_at):
+            return True
+        if self.version and self.version() != self.loaded_version:
+            return True
+        return False
+
+    def to_dict(self):
+        loaded_at = None
+        if self.loaded_at:
+            loaded_at = datetime.utcfromtimestamp(self.loaded_at).isoformat()
+        return {
+            "loaded": self.is_loaded,
+            "loaded_at": loaded_at,
+            "age_seconds": self.age_seconds,
+            "load_seconds": self.load_seconds,
+            "num_loads": self.num_loads,
+            "refresh_seconds": self.refresh_seconds,
+            "version": u"{}".format(self.loaded_version) if self.loaded_version is not None else None,
+            "depends_on": [dataset.name for dataset in self.depends_on],
+            "lazy": self.lazy,
+            "error": self.error
+        }
+
+    def __repr__(self):
+        return u"<Dataset ({}, loaded={})>".format(self.name, self.is_loaded)
+
+
+all_datasets = OrderedDict()
+
+def register_dataset(name, loader, refresh_seconds=None, version=None, depends_on=None, lazy=False):
+    all_datasets[name] = Dataset(name, loader, refresh_seconds, version, depends_on, lazy)
+    return all_datasets[name]
+
+class DatasetFamily(object):
+    """
+    Datasets keyed by a request parameter, like one per subscription package.
+
+    They aren't registered: the warm-up and refresh threads don't see them and they
+    don't hold up /ready.  Each is built by the first request for its key, at most
+    max_entries are kept (least recently used dropped first), and a request checks its
+    version at most every check_seconds, reloading when it moved or refresh_seconds passed.
+    """
+
+    def __init__(self, name, loader, version=None, refresh_seconds=None, max_entries=20, check_seconds=60):
+        self.name = name
+        self.loader = loader
+        self.version = version
+        self.refresh_seconds = refresh_seconds
+        self.max_entries = max_entries
+        self.check_seconds = check_seconds
+        self.datasets = OrderedDict()
+        self.checked_at = {}
+        self._lock = threading.Lock()
+        all_dataset_families[name] = self
+
+    def __contains__(self, key):
+        return key in self.datasets
+
+    def _get_dataset(self, key):
+        with self._lock:
+            dataset = self.datasets.pop(key, None)
+            if dataset is None:
+                version = (lambda: self.version(key)) if self.version else None
+                dataset = Dataset(u"{}_{}".format(self.name, key), lambda: self.loader(key), self.refresh_seconds, version)
+                self.checked_at[key] = time()
+            self.datasets[key] = dataset
+            while len(self.datasets) > self.max_entries:
+                (old_key, old_dataset) = self.datasets.popitem(last=False)
+                self.checked_at.pop(old_key, None)
+            return dataset
+
+    def get(self, key):
+        dataset = self._get_dataset(key)
+        if dataset.is_loaded and elapsed(self.checked_at.get(key, 0)) >= self.check_seconds:
+            self.checked_at[key] = time()
+            try:
+                if dataset.needs_refresh():
+                    dataset.refresh()
+            except Exception:
+                # keep serving the copy we have
+                logger.exception(u"refresh failed for dataset {}".format(dataset.name))
+        return dataset.get()
+
+    def to_dict(self):
+        return dict((dataset.name, dataset.to_dict()) for dataset in self.datasets.values())
+
+
+all_dataset_families = OrderedDict()
+
+def dataset_families_status():
+    return dict((name, family.to_dict()) for (name, family) in all_dataset_families.items())
+
+def table_version(tablename, bind_key="unpaywall_db"):
+    # moves whenever rows are written to the table, like when bq_transfer.py reloads it
+    command = "select n_tup_ins, n_tup_upd, n_tup_del from pg_stat_user_tables where relname = :tablename"
+    row = db.get_engine(app, bind=bind_key).execute(sql.text(command), tablename=tablename).first()
+    if not row:
+        return None
+    return tuple(row)
+
+def files_version(filenames):
+    return tuple(os.path.getmtime(filename) if os.path.exists(filename) else None for filename in filenames)
+
+def warm_up_datasets():
+    for dataset in all_datasets.values():
+        if dataset.lazy:
+            continue
+        try:
+            dataset.get()
+        except Exception:
+            logger.exception(u"warm-up failed for dataset {}".format(dataset.name))
+        finally:
+            # the objects were loaded eagerly, so let go of this thread's session
+            db.session.remove()
+
+def start_warm_up_thread():
+    thread = threading.Thread(target=warm_up_datasets, name="dataset-warm-up")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def refresh_datasets():
+    # registration order, so datasets are refreshed after the ones they depend on
+    for dataset in all_datasets.values():
+        try:
+            if dataset.needs_refresh():
+                dataset.refresh()
+        except Exception:
+            # keep serving the copy we have
+            logger.exception(u"refresh failed for dataset {}".format(dataset.name))
+        finally:
+            db.session.remove()
+
+def run_refresh_scheduler(check_seconds):
+    while True:
+        sleep(check_seconds)
+        refresh_datasets()
+
+def start_refresh_thread(check_seconds=60):
+    thread = threading.Thread(target=run_refresh_scheduler, args=(check_seconds,), name="dataset-refresh")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def datasets_status():
+    return dict((name, dataset.to_dict()) for (name, dataset) in all_datasets.iteritems())
+
+def datasets_ready():
+    return all(dataset.is_loaded for dataset in all_datasets.values() if not dataset.lazy)
@@ -0,0 +1,25 @@
+# rewrites the csv snapshot geo.py serves /metrics/geo* from, reading the oamonitor tables in redshift
+# run: python export_geo_snapshot.py
+
+import csv
+
+from app import logger
+from geo import geo_snapshot_filenames
+from geo import get_level_columns
+from geo import redshift_geo_source
+
+
+def export_geo_snapshot():
+    for (groupby, filename) in geo_snapshot_filenames.iteritems():
+        columns = get_level_columns(groupby, "*")
+        rows = redshift_geo_source.get_rows(groupby, columns)
+        with open(filename, "w") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow([row[column] for column in columns])
+        logger.info(u"wrote {} rows to {}".format(len(rows), filename))
+
+
+if __name__ == "__main__":
+    export_geo_snapshot()
@@ -0,0 +1,31 @@
+from data.funders import funder_names
+
+
+class FunderRegistry(object):
+    # data.funders is a plain list; this indexes it once so lookups don't scan it
+    def __init__(self, funders):
+        self.funders = funders
+        self.funders_by_id = dict((str(funder["id"]), funder) for funder in funders)
+        self.max_works_count = max([funder["works_count"] for funder in funders if funder.get("works_count")] or [0])
+
+        # lowercased once here rather than on every autocomplete request
+        self.lower_alternate_names = [(funder["alternate_names"] or u"").lower() for funder in funders]
+
+    def get(self, funder_id):
+        return self.funders_by_id.get(str(funder_id))
+
+    def get_policy(self, funder_id):
+        if not funder_id or funder_id == "null":
+            return "unspecified"
+        funder = self.get(funder_id)
+        if not funder:
+            return "not-supported-yet"
+        return funder["policy"]
+
+    def search(self, q):
+        # funders with q anywhere in their alternate names, in registry order
+        q = q.lower()
+        return [funder for (funder, names) in zip(self.funders, self.lower_alternate_names) if q in names]
+
+
+funder_registry = FunderRegistry(funder_names)
@@ -1,9 +1,12 @@
 from flask import request
 from time import time
+import os
+import hashlib
+from array import array
 from util import elapsed
+from util import read_csv_file
 from collections import defaultdict
 from sqlalchemy.orm import deferred
-from sqlalchemy.orm import undefer
 from sqlalchemy.orm import synonym
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import column_property
@@ -11,31 +14,16 @@ from cached_property import cached_property
 
 from app import db
 from app import get_db_cursor
-
-
-# really speeds things up to preload these, need them as a denominator for everything
-global_objects = None
-
-def get_oa_column(oa_filter_list):
-
-    all_columns = OAMonitorUnpaywallByCountry.__table__.columns
-    for attr in all_columns:
-        attr_name = attr.name
-        attr_name_parts = sorted([w.lower() for w in attr_name.split("_")])
-        if set(oa_filter_list) == set(attr_name_parts):
-            return attr_name
-    return u"_".join(sorted(oa_filter_list))
+from app import logger
+from datasets import register_dataset
+from datasets import files_version
 
 def get_geo_rows(groupby, oa_filter_list):
-    undefer_column = get_oa_column(oa_filter_list)
-    if groupby == "country":
-        objects = OAMonitorUnpaywallByCountry.query.options(undefer(undefer_column)).all()
-    elif groupby == "subcontinent":
-        objects = OAMonitorUnpaywallBySubcontinent.query.options(undefer(undefer_column)).all()
-    elif groupby == "continent":
-        objects = OAMonitorUnpaywallByContinent.query.options(undefer(undefer_column)).all()
+    # rows carry every oa column, so any oa filter can be read off them
+    if groupby in ("country", "subcontinent", "continent"):
+        (objects, timing) = get_geo_rows_fast(groupby, oa_columns)
     else:
-        objects = global_objects
+        objects = global_objects.get()
     return objects
 
 oa_columns = """
@@ -85,139 +73,331 @@ lookup = {
     },
 }
 
-def get_all_rows_fast(groupby, oa_column):
-    timing = {}
-    start_time = time()
-    with get_db_cursor() as cursor:
-        timing["0. in with"] = elapsed(start_time)
-
-        start_time = time()
-        q = "select {}, {} from {}".format(lookup[groupby]["__columns__"],
-                                             oa_column,
-                                             lookup[groupby]["__tablename__"])
-        # print q
-        cursor.execute(q)
-        timing["1. after execute"] = elapsed(start_time)
-
-        start_time = time()
-        rows = cursor.fetchall()
-        timing["2. after fetchall"] = elapsed(start_time)
-    return (rows, timing)
+# where each level gets its name, iso2, iso3, subcontinent and continent from
+geo_level_columns = {
+    "country": ["country", "country_iso2", "country_iso3", "subcontinent", "continent"],
+    "subcontinent": ["subcontinent", None, None, "subcontinent", "continent"],
+    "continent": ["continent", None, None, None, "continent"],
+    "global": [None, None, None, None, None]
+}
+
+def get_level_columns(groupby, oa_column):
+    # oa_column is whatever would go in the select list: one column, "a, b", or "*"
+    columns = [c.strip() for c in lookup[groupby]["__columns__"].split(",")]
+    if oa_column == "*":
+        columns += oa_columns
+    else:
+        columns += [c.strip() for c in oa_column.split(",")]
+    unique_columns = []
+    for column in columns:
+        if column not in unique_columns:
+            unique_columns.append(column)
+    return unique_columns
 
-def objects_from_rows(groupby, rows):
-    class_name = u"Geo{}".format(groupby.title())
-    my_class = globals()[class_name]
-    my_objects = [my_class(row) for row in rows]
-    return my_objects
 
-class GeoObject(object):
+class GeoDataSource(object):
+    name = None
 
-    def __init__(self, row):
-        self._row = row
-        for (k, v) in row.iteritems():
-            setattr(self, k, v)
+    def has_level(self, groupby, columns):
+        raise NotImplementedError
 
-    @classmethod
-    def get_all_rows(cls, oa_column):
+    def get_rows(self, groupby, columns):
+        raise NotImplementedError
+
+    def get_tuples(self, groupby, columns):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return u"<{} ({})>".format(self.__class__.__name__, self.name)
+
+
+class RedshiftGeoSource(GeoDataSource):
+    name = "redshift"
+
+    def has_level(self, groupby, columns):
+        return True
+
+    def get_rows(self, groupby, columns):
         with get_db_cursor() as cursor:
-            q = "select {}, {} from {}".format(cls.__columns__,
-                                                         oa_column,
-                                                         cls.__tablename__)
-            # print q
+            q = "select {} from {}".format(", ".join(columns), lookup[groupby]["__tablename__"])
             cursor.execute(q)
             rows = cursor.fetchall()
-        my_objects = [cls(row) for row in rows]
-        return my_objects
-
+        return rows
 
-    @property
-    def country_iso2_display(self):
-        if hasattr(self, "country_iso2"):
-            return self.country_iso2
-        else:
+    def get_tuples(self, groupby, columns):
+        with get_db_cursor(cursor_factory=None) as cursor:
+            q = "select {} from {}".format(", ".join(columns), lookup[groupby]["__tablename__"])
+            cursor.execute(q)
+            rows = cursor.fetchall()
+        return rows
+
+
+class SnapshotGeoSource(GeoDataSource):
+    """
+    Serves the oamonitor tables from csv exports instead of redshift.
+
+    Regenerate the files with `python export_geo_snapshot.py`.  Levels or columns
+    missing from the files are reported by has_level so callers fall back to redshift.
+    """
+    name = "snapshot"
+
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.dataset = register_dataset("geo_snapshot", self.load,
+                                        version=lambda: files_version(self.filenames.values()))
+
+    def load(self):
+        snapshot = {}
+        for (groupby, filename) in self.filenames.iteritems():
+            if not os.path.exists(filename):
+                continue
+            snapshot[groupby] = [self.typed_row(row) for row in read_csv_file(filename)]
+        return snapshot
+
+    @staticmethod
+    def typed_row(row):
+        # same types the redshift tables have: year stays text, counts are numbers
+        for column in ["num_distinct_articles"] + oa_columns:
+            if column in row:
+                row[column] = int(row[column]) if row[column] != "" else None
+        return row
+
+    def get_missing_columns(self, groupby, columns):
+        # None when the level isn't in the snapshot at all
+        rows = self.dataset.get().get(groupby)
+        if not rows:
             return None
+        return [column for column in columns if column not in rows[0]]
 
-    @property
-    def country_iso3_display(self):
-        if hasattr(self, "country_iso3"):
-            return self.country_iso3
-        else:
-            return None
+    def has_level(self, groupby, columns):
+        return self.get_missing_columns(groupby, columns) == []
 
-    @property
-    def continent_display(self):
-        if hasattr(self, "continent"):
-            return self.continent
-        else:
-            return None
+    def get_rows(self, groupby, columns):
+        # new dicts every time, callers are allowed to modify their rows
+        return [dict((column, row[column]) for column in columns) for row in self.dataset.get()[groupby]]
 
-    @property
-    def subcontinent_display(self):
-        if hasattr(self, "subcontinent"):
-            return self.subcontinent
+    def get_tuples(self, groupby, columns):
+        return [tuple([row[column] for column in columns]) for row in self.dataset.get()[groupby]]
+
+
+# anything read from redshift rather than the snapshot gets reloaded this often
+geo_refresh_seconds = 24 * 60 * 60
+
+geo_snapshot_filenames = {
+    "country": "data/oa_by_country.csv",
+    "subcontinent": "data/oa_by_subcontinent.csv",
+    "continent": "data/oa_by_continent.csv",
+    "global": "data/oa_global.csv"
+}
+
+redshift_geo_source = RedshiftGeoSource()
+snapshot_geo_source = SnapshotGeoSource(geo_snapshot_filenames)
+
+# (groupby, missing columns) we've already logged a redshift fallback for
+logged_geo_fallbacks = set()
+
+def get_geo_source(groupby, columns):
+    if os.getenv("GEO_DATA_SOURCE", "snapshot") != "snapshot":
+        return redshift_geo_source
+    missing_columns = snapshot_geo_source.get_missing_columns(groupby, columns)
+    if missing_columns == []:
+        return snapshot_geo_source
+    fallback_key = (groupby, tuple(missing_columns or []))
+    if fallback_key not in logged_geo_fallbacks:
+        logged_geo_fallbacks.add(fallback_key)
+        if missing_columns is None:
+            logger.info(u"geo snapshot has no {} level, reading it from redshift".format(groupby))
         else:
-            return None
+            logger.info(u"geo snapshot {} level is missing {}, reading it from redshift".format(groupby, u", ".join(missing_columns)))
+    return redshift_geo_source
 
-    @property
-    def year_int(self):
-        return int(self.year)
+def get_all_rows_fast(groupby, oa_column):
+    timing = {}
+    start_time = time()
+    columns = get_level_columns(groupby, oa_column)
+    source = get_geo_source(groupby, columns)
+    timing["0. source"] = source.name
 
-    @property
-    def bronze_gold_green_hybrid(self):
-        return self.is_oa
+    rows = source.get_rows(groupby, columns)
+    timing["1. after get_rows"] = elapsed(start_time)
+    return (rows, timing)
 
-    @property
-    def na(self):
-        return self.num_distinct_articles
+# column order of the /metrics/geo_all payload
+geo_all_keys = """
+    level
+    id
+    iso2
+    name
+    subcontinent
+    continent
+    closed
+    bronze_gold_green
+    gold_green_hybrid
+    bronze_gold_green_hybrid
+    bronze_gold_hybrid
+    bronze_green_hybrid
+    gold_hybrid
+    green_hybrid
+    green_gold
+    bronze_hybrid
+    bronze_gold
+    bronze_green
+    hybrid
+    gold
+    green
+    bronze
+    is_oa
+    num_distinct_articles
+    year""".split()
 
-    def __repr__(self):
-        return u"{} ({}, {})".format(self.__class__.__name__, self.lookup, self.year_int)
+# years from here on are incomplete, so the per-year numbers stop before it
+geo_end_year = 2019
 
+# first year of the per-year numbers when ?since= isn't given; views parse and check it
+default_since_year = 2009
 
+# oa_columns that geo_all has always exposed under a different name
+geo_all_renames = {
+    "bronze_green_gold": "bronze_gold_green",
+    "green_gold_hybrid": "gold_green_hybrid"
+}
 
-class GeoCountry(GeoObject):
-    __tablename__ = 'oamonitor_unpaywall_by_country'
-    __columns__ = 'country, country_iso2, country_iso3, subcontinent, continent, year, num_distinct_articles, is_oa'
+# short ids for names without an iso3 code, only ever computed once per name
+geo_all_ids = {}
 
-    @property
-    def lookup(self):
-        return self.country
+def get_geo_all_id(name):
+    if name not in geo_all_ids:
+        geo_all_ids[name] = hashlib.md5(name.encode()).hexdigest()[0:4]
+    return geo_all_ids[name]
 
+def get_geo_all_columns():
+    timing = {}
+    start_time = time()
 
-class GeoSubcontinent(GeoObject):
-    __tablename__ = 'oamonitor_unpaywall_by_subcontinent'
-    __columns__ = 'subcontinent, continent, year, num_distinct_articles, is_oa'
+    column_names = "level name iso2 iso3 subcontinent continent year num_distinct_articles".split() + oa_columns
+    levels = ["country", "subcontinent", "continent", "global"]
+
+    # levels the snapshot has come from memory, the rest from one redshift query
+    snapshot_levels = [level for level in levels
+                       if get_geo_source(level, get_level_columns(level, "*")) == snapshot_geo_source]
+    redshift_levels = [level for level in levels if level not in snapshot_levels]
+    timing["0. source"] = u", ".join(u"{}: {}".format(level, snapshot_geo_source.name if level in snapshot_levels else redshift_geo_source.name)
+                                     for level in levels)
+
+    rows_by_level = defaultdict(list)
+    for level in snapshot_levels:
+        for row in snapshot_geo_source.dataset.get()[level]:
+            row_values = [row[c] if c else None for c in geo_level_columns[level]]
+            if level == "global":
+                row_values[0] = "global"
+            if row_values[0]:
+                rows_by_level[level].append(tuple([level] + row_values + [row[c] for c in column_names[6:]]))
+
+    if redshift_levels:
+        # one union across the levels, every select lines up to the same columns
+        level_selects = []
+        for level in redshift_levels:
+            select_columns = ["'{}'".format(level)] + [c or "null" for c in geo_level_columns[level]]
+            if level == "global":
+                select_columns[1] = "'global'"
+            select_list = ", ".join(u"{} as {}".format(c, name) for (c, name) in zip(select_columns, column_names))
+            level_selects.append("select {}, year, num_distinct_articles, {} from {}".format(
+                select_list, ", ".join(oa_columns), lookup[level]["__tablename__"]))
+        q = "select * from ({}) as levels where name is not null and name != ''".format(
+            " union all ".join(level_selects))
+        with get_db_cursor(cursor_factory=None) as cursor:
+            cursor.execute(q)
+            for row in cursor.fetchall():
+                rows_by_level[row[0]].append(row)
+    rows = [row for level in levels for row in rows_by_level[level]]
+    timing["1. after fetchall"] = elapsed(start_time)
 
-    @property
-    def lookup(self):
-        return self.subcontinent
+    start_time = time()
+    if rows:
+        columns = dict(zip(column_names, [list(column) for column in zip(*rows)]))
+    else:
+        columns = dict((column_name, []) for column_name in column_names)
+
+    for (old_name, new_name) in geo_all_renames.iteritems():
+        columns[new_name] = columns.pop(old_name)
+    columns["bronze_gold_green_hybrid"] = columns["is_oa"]
+    columns["closed"] = [num - num_oa for (num, num_oa) in zip(columns["num_distinct_articles"], columns["is_oa"])]
+    columns["year"] = [int(year) for year in columns["year"]]
+    columns["id"] = [iso3 if level == "country" else get_geo_all_id(name)
+                     for (level, name, iso3) in zip(columns["level"], columns["name"], columns["iso3"])]
+
+    values = zip(*[columns[k] for k in geo_all_keys])
+    timing["2. after columns"] = elapsed(start_time)
+
+    return (geo_all_keys, values, timing)
+
+
+class GeoRow(object):
+    """
+    One (place, year) row of an oamonitor table.
+
+    Built straight from a cursor tuple, with the year and lookup worked out once here
+    instead of on every access inside the geo loops.  oa_counts lines up with whatever
+    oa columns the rows were fetched with.
+    """
+    __slots__ = ("lookup", "country_iso2_display", "country_iso3_display", "subcontinent_display",
+                 "continent_display", "year", "year_int", "num_distinct_articles", "oa_counts")
+
+    def __init__(self, lookup, country_iso2, country_iso3, subcontinent, continent, year, num_distinct_articles, oa_counts):
+        self.lookup = lookup
+        self.country_iso2_display = country_iso2
+        self.country_iso3_display = country_iso3
+        self.subcontinent_display = subcontinent
+        self.continent_display = continent
+        self.year = year
+        self.year_int = int(year)
+        self.num_distinct_articles = num_distinct_articles
+        self.oa_counts = oa_counts
 
+    def __repr__(self):
+        return u"{} ({}, {})".format(self.__class__.__name__, self.lookup, self.year_int)
 
-class GeoContinent(GeoObject):
-    __tablename__ = 'oamonitor_unpaywall_by_continent'
-    __columns__ = 'continent, year, num_distinct_articles, is_oa'
 
-    @property
-    def lookup(self):
-        return self.continent
+def get_geo_rows_fast(groupby, oa_column_names):
+    timing = {}
+    start_time = time()
 
+    place_columns = geo_level_columns[groupby]
+    columns = []
+    for column in [c for c in place_columns if c] + ["year", "num_distinct_articles"] + oa_column_names:
+        if column not in columns:
+            columns.append(column)
+    source = get_geo_source(groupby, columns)
+    timing["0. source"] = source.name
 
-class GeoGlobal(GeoObject):
-    __tablename__ = 'oamonitor_unpaywall_worldwide'
-    __columns__ = 'year, num_distinct_articles, is_oa'
+    tuples = source.get_tuples(groupby, columns)
+    timing["1. after get_tuples"] = elapsed(start_time)
+    start_time = time()
 
-    @property
-    def lookup(self):
-        return "global"
+    place_positions = [columns.index(c) if c else None for c in place_columns]
+    year_position = columns.index("year")
+    num_position = columns.index("num_distinct_articles")
+    oa_positions = [columns.index(c) for c in oa_column_names]
+
+    rows = []
+    for t in tuples:
+        place = [t[p] if p is not None else None for p in place_positions]
+        if groupby == "global":
+            place[0] = "global"
+        rows.append(GeoRow(place[0], place[1], place[2], place[3], place[4],
+                           t[year_position],
+                           t[num_position],
+                           tuple([t[p] for p in oa_positions])))
+    timing["2. after geo_rows"] = elapsed(start_time)
+
+    return (rows, timing)
 
 
 
-def get_oa_from_redshift(my_key):
+def get_oa_from_redshift(my_key, since_year=default_since_year):
     timing = {}
     start_time = time()
 
-    since_year = int(request.args.get("since", "2009"))
-
     oa_request = request.args.get("oa", "all")
     if oa_request in ("all", "any"):
         oa_request = "bronze,green,gold,hybrid"
@@ -226,7 +406,7 @@ def get_oa_from_redshift(my_key):
 
     global_response = None
     if my_key and my_key != "global":
-        (global_response, global_timing) = get_oa_from_redshift("global")
+        (global_response, global_timing) = get_oa_from_redshift("global", since_year)
         timing["0.5. get_global"] = global_timing
     else:
         my_key = "global"
@@ -240,13 +420,13 @@ def get_oa_from_redshift(my_key):
     out_of_over_years = defaultdict(int)
     value_over_years = defaultdict(int)
     oa_histogram = defaultdict(list)
-    oa_data_column = get_oa_column(oa_filter_list)
+    oa_index = oa_columns.index(get_oa_column_name(oa_filter_list))
 
     for obj in objects:
-        if obj.year_int >= since_year and obj.year_int < 2019:
-            column_value = getattr(obj, oa_data_column)
-            oa_histogram[obj.lookup] += [(obj.year_int,
-                                      round(float(column_value)/int(obj.num_distinct_articles), 5))]
+        if obj.year_int >= since_year and obj.year_int < geo_end_year:
+            column_value = obj.oa_counts[oa_index]
+            oa_histogram[obj.lookup].append((obj.year_int,
+                                             round(float(column_value)/int(obj.num_distinct_articles), 5)))
             value_over_years[obj.lookup] += int(column_value)
             out_of_over_years[obj.lookup] += int(obj.num_distinct_articles)
 
@@ -287,12 +467,10 @@ def get_oa_from_redshift(my_key):
 
 
 
-def get_oa_from_redshift_fast(groupby):
+def get_oa_from_redshift_fast(groupby, since_year=default_since_year):
     timing = {}
     start_time = time()
 
-    since_year = request.args.get("since", "2009")
-
     oa_request = request.args.get("oa", "all")
     if oa_request in ("all", "any"):
         oa_request = "bronze,green,gold,hybrid"
@@ -301,7 +479,7 @@ def get_oa_from_redshift_fast(groupby):
 
     global_response = None
     if groupby and groupby != "global":
-        (global_response, global_timing) = get_oa_from_redshift("global")
+        (global_response, global_timing) = get_oa_from_redshift("global", since_year)
         timing["0.5. get_global"] = global_timing
     else:
         groupby = "global"
@@ -309,45 +487,42 @@ def get_oa_from_redshift_fast(groupby):
     this_start = time()
     undefer_column = get_oa_column_name(oa_filter_list)
     if groupby == "subcontinent_as_country":
-        (subcontinent_rows, subcontinent_timing) = get_all_rows_fast("subcontinent", undefer_column)
-        (country_rows, rows_timing) = get_all_rows_fast("country", undefer_column)
-        groupby = "country"
-        rows = []
+        (subcontinent_rows, subcontinent_timing) = get_geo_rows_fast("subcontinent", [undefer_column])
+        (country_rows, rows_timing) = get_geo_rows_fast("country", [undefer_column])
+        subcontinent_rows_by_key = dict(((r.subcontinent_display, r.year), r) for r in subcontinent_rows)
+        objects = []
         for row in country_rows:
-            new_row = row
-            matching_subcontinent_rows = [r for r in subcontinent_rows if row["year"]==r["year"] and row["subcontinent"]==r["subcontinent"]]
-            for k in ["num_distinct_articles", "is_oa", undefer_column]:
-                new_row[k] = matching_subcontinent_rows[0][k]
-            new_row["country"] = u"{} ({})".format(row["country"], row["subcontinent"])
-            rows.append(new_row)
+            matching_subcontinent_row = subcontinent_rows_by_key.get((row.subcontinent_display, row.year), None)
+            if not matching_subcontinent_row:
+                continue
+            objects.append(GeoRow(u"{} ({})".format(row.lookup, row.subcontinent_display),
+                                  row.country_iso2_display,
+                                  row.country_iso3_display,
+                                  row.subcontinent_display,
+                                  row.continent_display,
+                                  row.year,
+                                  matching_subcontinent_row.num_distinct_articles,
+                                  matching_subcontinent_row.oa_counts))
     else:
-        (rows, rows_timing) = get_all_rows_fast(groupby, undefer_column)
+        (objects, rows_timing) = get_geo_rows_fast(groupby, [undefer_column])
     timing["1. get_geo_rows"] = rows_timing
     this_start = time()
 
-    objects = objects_from_rows(groupby, rows)
-    timing["1.5 get_geo_objects"] = elapsed(this_start)
-    this_start = time()
-
     response = {}
     oa_histogram = defaultdict(list)
-    oa_data_column = get_oa_column(oa_filter_list)
 
     for obj in objects:
-        if obj.year >= since_year and obj.year_int < 2019:
-            column_value = getattr(obj, oa_data_column)
-            oa_histogram[obj.lookup] += [(obj.year_int,
-                                      round(float(column_value)/int(obj.num_distinct_articles), 5))]
+        if obj.year_int >= since_year and obj.year_int < geo_end_year:
+            oa_histogram[obj.lookup].append((obj.year_int,
+                                             round(float(obj.oa_counts[0])/int(obj.num_distinct_articles), 5)))
 
     timing["2. first_loop"] = elapsed(this_start)
 
     this_start = time()
 
-    sorted_objects = sorted(objects, key=lambda x: x.lookup, reverse=False)
-
     for obj in objects:
-        if since_year==obj.year and obj.lookup:
-            column_value = getattr(obj, oa_data_column)
+        if since_year==obj.year_int and obj.lookup:
+            column_value = obj.oa_counts[0]
             distinct_articles_proportion_global = 1
             if global_response:
                 distinct_articles_proportion_global = float(obj.num_distinct_articles) / global_response["global"]["articles"]["num_total"]
@@ -381,6 +556,122 @@ def get_oa_from_redshift_fast(groupby):
 
 
 
+class GeoCountryCube(object):
+    """
+    oamonitor_unpaywall_by_country held as arrays, one per (column, country) indexed by year.
+
+    Lets us sum any group of countries in memory.  Articles with authors in more than
+    one member country are counted once per country, same as adding up the country rows.
+    """
+
+    columns = ["country", "country_iso2", "country_iso3", "year", "num_distinct_articles"] + oa_columns
+
+    def __init__(self, rows):
+        self.years = sorted(set(int(row["year"]) for row in rows))
+        year_index = dict((year, i) for (i, year) in enumerate(self.years))
+        self.countries = []
+        self.country_index = {}
+        self.counts = dict((column, []) for column in ["num_distinct_articles"] + oa_columns)
+
+        index_by_name = {}
+        for row in rows:
+            if row["country"] not in index_by_name:
+                index = len(self.countries)
+                index_by_name[row["country"]] = index
+                self.countries.append({
+                    "name": row["country"],
+                    "iso2": row["country_iso2"],
+                    "iso3": row["country_iso3"]
+                })
+                for code in (row["country_iso2"], row["country_iso3"]):
+                    if code:
+                        self.country_index[code.upper()] = index
+                for column in self.counts:
+                    self.counts[column].append(array("l", [0] * len(self.years)))
+
+            index = index_by_name[row["country"]]
+            for column in self.counts:
+                self.counts[column][index][year_index[int(row["year"])]] = row[column] or 0
+
+    def find_countries(self, codes):
+        country_indexes = []
+        not_found = []
+        for code in codes:
+            index = self.country_index.get(code.strip().upper(), None)
+            if index is None:
+                not_found.append(code)
+            elif index not in country_indexes:
+                country_indexes.append(index)
+        return (country_indexes, not_found)
+
+    def sum_by_year(self, column, country_indexes, since_year, end_year):
+        column_counts = self.counts[column]
+        return [(year, sum(column_counts[c][i] for c in country_indexes))
+                for (i, year) in enumerate(self.years) if since_year <= year < end_year]
+
+
+def load_geo_country_cube():
+    source = get_geo_source("country", GeoCountryCube.columns)
+    return GeoCountryCube(source.get_rows("country", GeoCountryCube.columns))
+
+geo_country_cube = register_dataset("geo_country_cube", load_geo_country_cube,
+                                    refresh_seconds=geo_refresh_seconds,
+                                    depends_on=[snapshot_geo_source.dataset])
+
+
+def get_oa_for_region(country_codes, region_name=None, since_year=default_since_year):
+    timing = {}
+    start_time = time()
+
+    oa_request = request.args.get("oa", "all")
+    if oa_request in ("all", "any"):
+        oa_request = "bronze,green,gold,hybrid"
+    oa_filter_list = [w.strip() for w in oa_request.lower().split(",")]
+    oa_column = get_oa_column_name(oa_filter_list)
+
+    cube = geo_country_cube.get()
+    if oa_column not in cube.counts:
+        raise ValueError(u"oa must be a combination of bronze, green, gold and hybrid")
+    (country_indexes, not_found) = cube.find_countries(country_codes)
+    timing["0. prep_elapsed"] = elapsed(start_time)
+
+    (global_response, global_timing) = get_oa_from_redshift("global", since_year)
+    timing["0.5. get_global"] = global_timing
+    this_start = time()
+
+    num_total_by_year = cube.sum_by_year("num_distinct_articles", country_indexes, since_year, geo_end_year)
+    num_oa_by_year = cube.sum_by_year(oa_column, country_indexes, since_year, geo_end_year)
+    num_total = sum(num for (year, num) in num_total_by_year)
+    num_oa = sum(num for (year, num) in num_oa_by_year)
+
+    prop_oa_by_year = [(year, round(float(num_oa_this_year)/num_total_this_year, 5))
+                       for ((year, num_total_this_year), (_, num_oa_this_year)) in zip(num_total_by_year, num_oa_by_year)
+                       if num_total_this_year]
+    global_num_total = global_response["global"]["articles"]["num_total"] if global_response else None
+
+    response = {
+        "name": region_name,
+        "countries": [cube.countries[i] for i in country_indexes],
+        "not_found": not_found,
+        "since": since_year,
+        "oa_types": oa_filter_list,
+        "articles": {
+            "num_total": num_total,
+            "prop_global": round(float(num_total) / global_num_total, 5) if global_num_total else None,
+            "num_oa": num_oa,
+            "prop_oa": round(float(num_oa) / num_total, 5) if num_total else None,
+            "prop_oa_by_year": prop_oa_by_year,
+            "num_total_by_year": num_total_by_year,
+            "num_oa_by_year": num_oa_by_year
+        }
+    }
+    timing["1. sum_countries"] = elapsed(this_start)
+    timing["9. TOTAL"] = elapsed(start_time)
+
+    return (response, timing)
+
+
+
 class GeoRowMixin(object):
     @cached_property
     def country_iso2_display(self):
@@ -563,7 +854,11 @@ class OAMonitorUnpaywallWorldwide(db.Model, GeoRowMixin):
         }
 
 def preload_global_objects():
-    return OAMonitorUnpaywallWorldwide.query.options(undefer('*')).all()
+    (rows, timing) = get_geo_rows_fast("global", oa_columns)
+    return rows
+
+# really speeds things up to preload these, need them as a denominator for everything
+global_objects = register_dataset("global_objects", preload_global_objects,
+                                  refresh_seconds=geo_refresh_seconds,
+                                  depends_on=[snapshot_geo_source.dataset])
 
-# initial set is at the top of the file
-global_objects = preload_global_objects()
@@ -1,4 +1,12 @@
+import re
+from array import array
+from unidecode import unidecode
+
 from app import db
+from datasets import register_dataset
+from datasets import table_version
+from util import remove_punctuation
+from prefix_cache import PrefixCache
 
 
 class Institution(db.Model):
@@ -13,12 +21,101 @@ class Institution(db.Model):
     num_papers = db.Column(db.Numeric)
 
     def to_dict(self):
-        response = {
-            "id": self.grid_id,
-            "name": self.org_name,
-            "country": self.country,
-            "country_code": self.country_code,
-            "continent": self.continent,
-            "num_papers": self.num_papers
-        }
-        return response
+        return institution_to_dict(self)
+
+
+def institution_to_dict(institution):
+    # works for Institution objects and for the plain rows the name index holds
+    response = {
+        "id": institution.grid_id,
+        "name": institution.org_name,
+        "country": institution.country,
+        "country_code": institution.country_code,
+        "continent": institution.continent,
+        "num_papers": institution.num_papers
+    }
+    return response
+
+
+def normalize_name(text):
+    # lowercase, ascii, no punctuation, single spaces.  unlike util.normalize this keeps
+    # stop words, so "the" matches names containing "the" the way org_name ilike '%the%' did
+    response = unidecode(unicode((text or u"").lower()))
+    response = remove_punctuation(response)
+    return re.sub(ur"\s+", u" ", response).strip()
+
+def get_trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class InstitutionNameIndex(object):
+    # substring search over normalized names, standing in for org_name ilike '%q%'.
+    # institutions are numbered in num_papers order, so every posting list is
+    # already in result order and we can stop at the first `limit` hits.
+    def __init__(self, rows):
+        # nulls first, same as the order by num_papers desc this replaced
+        self.institutions = sorted(rows, key=lambda row: (row.num_papers is None, row.num_papers), reverse=True)
+        self.names = [normalize_name(row.org_name) for row in self.institutions]
+        self.max_num_papers = max([row.num_papers for row in rows if row.num_papers] or [0])
+        trigram_postings = {}
+        for (i, name) in enumerate(self.names):
+            for trigram in get_trigrams(name):
+                trigram_postings.setdefault(trigram, array("l")).append(i)
+        self.trigram_postings = trigram_postings
+        self.cache = PrefixCache("institution_names", max_candidates=2000)
+
+    def match(self, normalized_q, max_matches=None):
+        # numbers of the institutions whose name contains normalized_q, in num_papers order,
+        # stopping once there are max_matches of them
+        postings = [self.trigram_postings.get(trigram, ()) for trigram in get_trigrams(normalized_q)]
+        matches = []
+        for i in min(postings, key=len):
+            if normalized_q in self.names[i]:
+                matches.append(i)
+                if max_matches and len(matches) >= max_matches:
+                    break
+        return matches
+
+    def search(self, q, limit=10):
+        normalized_q = normalize_name(q)
+        if not normalized_q:
+            return []
+        if len(normalized_q) < 3:
+            # matches most names, so walk them in num_papers order and stop early
+            matches = []
+            for (i, name) in enumerate(self.names):
+                if normalized_q in name:
+                    matches.append(i)
+                    if len(matches) >= limit:
+                        break
+        elif limit > self.cache.max_candidates:
+            matches = self.match(normalized_q, max_matches=limit)
+        else:
+            # a longer query is a longer substring, so it can only narrow a prefix's matches.
+            # a cold prefix stops one past max_candidates: a list that short is complete and
+            # gets cached, a longer one is cut off, never cached, and still has the top `limit`
+            matches = self.cache.lookup(
+                normalized_q,
+                normalized_q,
+                build=lambda: self.match(normalized_q, max_matches=self.cache.max_candidates + 1),
+                refine=lambda matches: [i for i in matches if normalized_q in self.names[i]]
+            )
+        return [self.institutions[i] for i in matches[:limit]]
+
+def load_institution_name_index():
+    rows = db.session.query(
+        Institution.grid_id,
+        Institution.org_name,
+        Institution.country,
+        Institution.country_code,
+        Institution.continent,
+        Institution.num_papers
+    ).all()
+    return InstitutionNameIndex(rows)
+
+institution_name_index = register_dataset("institution_name_index",
+                                          load_institution_name_index,
+                                          version=lambda: table_version("bq_institutions"))
+
+def search_institution_names(q, limit=10):
+    return institution_name_index.get().search(q, limit)
@@ -1,79 +1,41 @@
-import random
 import re
-from sqlalchemy import sql
+import heapq
+import bisect
+from collections import defaultdict
+from sqlalchemy import orm
 
 from app import db
 from topic import Topic
-from data.funders import funder_names
+from topic import topic_index
+from topic import TopicRecord
+from funder import funder_registry
 from transformative_agreement import TransformativeAgreement
-from institution import Institution
+from transformative_agreement import TransformativeAgreementIndex
+from datasets import register_dataset
+from datasets import table_version
+from text_search import TextIndex
 
 THRESHOLD_PROP_CC_BY_SINCE_2018 = .90
-all_transformative_agreements = TransformativeAgreement.query.all()
 
-class Journal(db.Model):
-    __tablename__ = 'bq_our_journals_issnl'
-    __bind_key__ = "unpaywall_db"
+# funder id -> issnls that funder has its own agreement with
+funder_specific_agreements = {
+    "100000865": ["0028-4793"],  # gates and NEJM
+}
 
-    issnl  =  db.Column(db.Text, primary_key=True)
-    title	 =  db.Column(db.Text)
-    sjr	 =  db.Column(db.Numeric)
-    sjr_best_quartile	 =  db.Column(db.Text)
-    h_index	 =  db.Column(db.Numeric)
-    cites_per_article	 =  db.Column(db.Numeric)
-    country	 =  db.Column(db.Text)
-    publisher_country_code = db.Column(db.Text)
-    publisher_continent = db.Column(db.Text)
-    society_or_institution	 =  db.Column(db.Text)
-    publisher	 =  db.Column(db.Text)
-    categories	 =  db.Column(db.Text)
-    num_articles	 =  db.Column(db.Numeric)
-    num_cc_by	 =  db.Column(db.Numeric)
-    prop_cc_by	 =  db.Column(db.Numeric)
-    prop_oa	 =  db.Column(db.Numeric)
-    num_oa	 =  db.Column(db.Numeric)
-    num_articles_since_2018	 =  db.Column(db.Numeric)
-    num_cc_by_since_2018	 =  db.Column(db.Numeric)
-    prop_cc_by_since_2018	 =  db.Column(db.Numeric)
-    prop_oa_since_2018	 =  db.Column(db.Numeric)
-    num_oa_since_2018	 =  db.Column(db.Numeric)
-    five_dois	 =  db.Column(db.Text)
-    newest_published_date	 =  db.Column(db.Text)
-    oldest_published_date	 =  db.Column(db.Text)
-    has_apcs	 =  db.Column(db.Text)
-    apc_url	 =  db.Column(db.Text)
-    apc_fee	 =  db.Column(db.Numeric)
-    apc_currency	 =  db.Column(db.Text)
-    has_submission_fee	=  db.Column(db.Boolean)
-    submission_fee_url	 =  db.Column(db.Text)
-    submission_fee	 =  db.Column(db.Numeric)
-    submission_fee_currency	 =  db.Column(db.Text)
-    has_apc_waiver	=  db.Column(db.Boolean)
-    apc_waiver_url	 =  db.Column(db.Text)
-    first_year_oa	 =  db.Column(db.Numeric)
-    languages	 =  db.Column(db.Text)
-    editorial_board_url	 =  db.Column(db.Text)
-    review_process	 =  db.Column(db.Text)
-    review_process_url	 =  db.Column(db.Text)
-    aims_scope_url	 =  db.Column(db.Text)
-    instructions_to_authors_url	 =  db.Column(db.Text)
-    plagiarism_screening_policy	=  db.Column(db.Boolean)
-    plagiarism_screening_url	 =  db.Column(db.Text)
-    weeks_submission_to_publication	 =  db.Column(db.Numeric)
-    oa_statement_url	 =  db.Column(db.Text)
-    license	 =  db.Column(db.Text)
-    license_attributes	 =  db.Column(db.Text)
-    licence_url	 =  db.Column(db.Text)
-    author_holds_copyright_no_restictions	=  db.Column(db.Boolean)
-    copyright_url	 =  db.Column(db.Text)
-    author_holds_publishing_rights_no_restictions	=  db.Column(db.Boolean)
-    publishing_rights_url	=  db.Column(db.Text)
+transformative_agreement_index = register_dataset("transformative_agreements",
+                                                  lambda: TransformativeAgreementIndex(TransformativeAgreement.query.all()),
+                                                  version=lambda: (table_version("bq_transformative_agreement"),
+                                                                   table_version("bq_transformative_agreement_issnl_matches")))
 
-    topics = db.relationship(
-        'Topic',
-        lazy='subquery',
-        cascade="all"
-    )
+def parse_five_dois(five_dois):
+    try:
+        return [u"https://doi.org/{}".format(doi) for doi in re.findall(r'\"(10.*?)\"', five_dois)]
+    except:
+        return []
+
+class JournalMixin(object):
+    # rendering shared by Journal and the detached JournalRecord in the catalog
+    __slots__ = ()
 
     def get_journal_url_from_issn(self):
         # url = "https://portal.issn.org/resource/ISSN/{}?format=json".format(self.issnl)
@@ -101,34 +63,13 @@ class Journal(db.Model):
     def is_gold_oa(self):
         return self.prop_cc_by_since_2018 >= THRESHOLD_PROP_CC_BY_SINCE_2018
 
+    @property
+    def is_mirror_journal(self):
+        return is_mirror_journal_title(self.title)
+
     def get_similar_journals(self):
-        # use this to try all topics
-        # topic_string = ",".join(["'{}'".format(t) for t in self.topic_names])
-        # use this to just match on first topic
-        first_topic = self.topic_names[0]
-        topic_string = ",".join(["'{}'".format(t) for t in [first_topic]])
-
-        command = """select issnl from bq_our_journals_issnl
-                where issnl != '{my_issnl}'
-                and issnl in (select issnl from bq_scimago_issnl_topics where topic in ({my_topics}))
-                and prop_cc_by_since_2018 >= {thresh}
-                order by (abs(sjr - {my_sjr})) asc
-                limit 4""".format(my_issnl=self.issnl, my_sjr=self.sjr, my_topics=topic_string, thresh=THRESHOLD_PROP_CC_BY_SINCE_2018)
-        res = db.session.connection().execute(sql.text(command))
-        rows = res.fetchall()
-
-        issnls = [row[0] for row in rows]
-        our_journals = Journal.query.filter(Journal.issnl.in_(issnls)).all()
-        our_journals.sort(key=lambda this_object: abs(self.sjr - (this_object.sjr or 0)), reverse=False)
-
-        broad_oa_journal_issns = ["1932-6203", "2041-1723", "2045-2322"] #plos one, nature communications, scientific reports
-        if "medicine" in u",".join(["'{}'".format(t.lower()) for t in self.topic_names]):
-            broad_oa_journal_issns += ["2167-8359", "2046-1402"]  # peerj, f1000research
-        broad_oa_journal_issns = [issn for issn in broad_oa_journal_issns if issn not in issnls]
-        broad_oa_journals = Journal.query.filter(Journal.issnl.in_(broad_oa_journal_issns)).all()
-        our_journals += random.sample(broad_oa_journals, 5 - len(our_journals))
-
-        return our_journals
+        issnls = similar_journal_index.get().similar_issnls(self.issnl, self.topic_names, self.sjr)
+        return journal_catalog.get().get_many(issnls)
 
     def is_compliant(self, funder_id=None, institution=None):
         funder_dict = self.get_policy_dict(funder_id, institution)
@@ -159,15 +100,7 @@ class Journal(db.Model):
             institution_id = institution.grid_id
         else:
             institution_id = None
-        if not funder_id or funder_id == "null":
-            policy = "unspecified"
-        else:
-            # default
-            policy = "not-supported-yet"
-            matching_funders = [f for f in funder_names if str(f["id"])==funder_id]
-            if matching_funders:
-                funder_dict = matching_funders[0]
-                policy = funder_dict["policy"]
+        policy = funder_registry.get_policy(funder_id)
 
         policy_dict = {"policy": policy, "compliant": True, "reason": [], "query": {"funder": funder_id, "institution": institution_id}}
 
@@ -180,20 +113,18 @@ class Journal(db.Model):
                 policy_dict["reason"] = ["gold-oa"]
 
             #### mirror journals
-            if self.title and self.title.lower().endswith(" x"):
+            if self.is_mirror_journal:
                     policy_dict["compliant"] = False
                     policy_dict["reason"] = ["mirror-journal"]
 
             #### funder specific policies
-            # if NEJM and gates, is compliant
-            if funder_id=="100000865" and self.issnl=="0028-4793":
+            if self.issnl in funder_specific_agreements.get(funder_id, []):
                     policy_dict["compliant"] = True
                     policy_dict["reason"] = ["funder-specific-agreement"]
 
             #### transformative agreements
             if institution:
-                for my_ta in all_transformative_agreements:
-                    if my_ta.applies(self.issnl, institution):
+                for my_ta in transformative_agreement_index.get().applying(self.issnl, institution):
                         policy_dict["compliant"] = True
                         policy_dict["reason"] += ["transformative-agreement"]
                         policy_dict["transformative_agreement_id"] = my_ta.id
@@ -211,10 +142,6 @@ class Journal(db.Model):
 
 
     def to_dict_journal_row(self, funder_id=None, institution=None):
-        try:
-            recent_articles = [u"https://doi.org/{}".format(doi) for doi in re.findall(r'\"(10.*?)\"', self.five_dois)]
-        except:
-            recent_articles = []
         response = {
             "id": self.issnl,
             "name": self.title,
@@ -229,7 +156,7 @@ class Journal(db.Model):
             "cites_per_article": self.cites_per_article / 100,  # is actually x100 in db
             "sjr": self.sjr,
             "sjr_best_quartile": self.sjr_best_quartile,
-            "recent_articles": recent_articles,
+            "recent_articles": self.recent_articles,
             "newest_published_date": self.newest_published_date,
             "oldest_published_date": self.oldest_published_date,
             "policy_compliance": self.get_policy_dict(funder_id, institution)
@@ -285,3 +212,252 @@ class Journal(db.Model):
         response["similar_journals"] = [j.to_dict_journal_row(funder_id, institution) for j in self.get_similar_journals()]
 
         return response
+
+
+class Journal(db.Model, JournalMixin):
+    __tablename__ = 'bq_our_journals_issnl'
+    __bind_key__ = "unpaywall_db"
+
+    issnl  =  db.Column(db.Text, primary_key=True)
+    title	 =  db.Column(db.Text)
+    sjr	 =  db.Column(db.Numeric)
+    sjr_best_quartile	 =  db.Column(db.Text)
+    h_index	 =  db.Column(db.Numeric)
+    cites_per_article	 =  db.Column(db.Numeric)
+    country	 =  db.Column(db.Text)
+    publisher_country_code = db.Column(db.Text)
+    publisher_continent = db.Column(db.Text)
+    society_or_institution	 =  db.Column(db.Text)
+    publisher	 =  db.Column(db.Text)
+    categories	 =  db.Column(db.Text)
+    num_articles	 =  db.Column(db.Numeric)
+    num_cc_by	 =  db.Column(db.Numeric)
+    prop_cc_by	 =  db.Column(db.Numeric)
+    prop_oa	 =  db.Column(db.Numeric)
+    num_oa	 =  db.Column(db.Numeric)
+    num_articles_since_2018	 =  db.Column(db.Numeric)
+    num_cc_by_since_2018	 =  db.Column(db.Numeric)
+    prop_cc_by_since_2018	 =  db.Column(db.Numeric)
+    prop_oa_since_2018	 =  db.Column(db.Numeric)
+    num_oa_since_2018	 =  db.Column(db.Numeric)
+    five_dois	 =  db.Column(db.Text)
+    newest_published_date	 =  db.Column(db.Text)
+    oldest_published_date	 =  db.Column(db.Text)
+    has_apcs	 =  db.Column(db.Text)
+    apc_url	 =  db.Column(db.Text)
+    apc_fee	 =  db.Column(db.Numeric)
+    apc_currency	 =  db.Column(db.Text)
+    has_submission_fee	=  db.Column(db.Boolean)
+    submission_fee_url	 =  db.Column(db.Text)
+    submission_fee	 =  db.Column(db.Numeric)
+    submission_fee_currency	 =  db.Column(db.Text)
+    has_apc_waiver	=  db.Column(db.Boolean)
+    apc_waiver_url	 =  db.Column(db.Text)
+    first_year_oa	 =  db.Column(db.Numeric)
+    languages	 =  db.Column(db.Text)
+    editorial_board_url	 =  db.Column(db.Text)
+    review_process	 =  db.Column(db.Text)
+    review_process_url	 =  db.Column(db.Text)
+    aims_scope_url	 =  db.Column(db.Text)
+    instructions_to_authors_url	 =  db.Column(db.Text)
+    plagiarism_screening_policy	=  db.Column(db.Boolean)
+    plagiarism_screening_url	 =  db.Column(db.Text)
+    weeks_submission_to_publication	 =  db.Column(db.Numeric)
+    oa_statement_url	 =  db.Column(db.Text)
+    license	 =  db.Column(db.Text)
+    license_attributes	 =  db.Column(db.Text)
+    licence_url	 =  db.Column(db.Text)
+    author_holds_copyright_no_restictions	=  db.Column(db.Boolean)
+    copyright_url	 =  db.Column(db.Text)
+    author_holds_publishing_rights_no_restictions	=  db.Column(db.Boolean)
+    publishing_rights_url	=  db.Column(db.Text)
+
+    topics = db.relationship(
+        'Topic',
+        lazy='subquery',
+        cascade="all"
+    )
+
+    @orm.reconstructor
+    def init_on_load(self):
+        # five_dois is a json-ish list of dois; parse it once, not on every render
+        self.recent_articles = parse_five_dois(self.five_dois)
+
+
+journal_column_names = [column.key for column in Journal.__table__.columns]
+
+class JournalRecord(JournalMixin):
+    # a Journal row without the session: every column, plus topics and parsed five_dois
+    __slots__ = journal_column_names + ["topics", "recent_articles"]
+
+    def __init__(self, row, topics):
+        for column_name in journal_column_names:
+            setattr(self, column_name, getattr(row, column_name))
+        self.topics = topics
+        self.recent_articles = parse_five_dois(self.five_dois)
+
+class JournalCatalog(object):
+    def __init__(self, records):
+        self.journals = dict((record.issnl, record) for record in records)
+
+    def __len__(self):
+        return len(self.journals)
+
+    def get(self, issnl):
+        return self.journals.get(issnl)
+
+    def get_many(self, issnls):
+        # in the order asked for, skipping issnls we don't have
+        return [self.journals[issnl] for issnl in issnls if issnl in self.journals]
+
+def load_journal_catalog():
+    topics_by_issnl = defaultdict(list)
+    for (issnl, topic, quadrant) in db.session.query(Topic.issnl, Topic.topic, Topic.quadrant):
+        topics_by_issnl[issnl].append(TopicRecord(topic, quadrant))
+    rows = db.session.query(*[getattr(Journal, column_name) for column_name in journal_column_names]).all()
+    return JournalCatalog([JournalRecord(row, topics_by_issnl[row.issnl]) for row in rows])
+
+# journals change only when bq_transfer.py reloads the tables, so every journal page reads from here
+journal_catalog = register_dataset("journal_catalog",
+                                   load_journal_catalog,
+                                   version=lambda: (table_version("bq_our_journals_issnl"),
+                                                    table_version("bq_scimago_issnl_topics")))
+
+
+class JournalTitleIndex(object):
+    # what the title autocomplete and search need, without a query per keystroke
+    def __init__(self, rows):
+        self.journals = dict((row.issnl, row) for row in rows)
+        self.max_num_articles_since_2018 = max([row.num_articles_since_2018 for row in rows if row.num_articles_since_2018] or [0])
+        self.text_index = TextIndex(((row.issnl, row.title) for row in rows), cache_name="journal_titles")
+
+    def search(self, q, limit=None):
+        # (journal row, fulltext rank) pairs, best first by num_articles_since_2018 + 10000 * rank
+        hits = [(self.journals[issnl], rank) for (issnl, rank) in self.text_index.search(q)]
+        score = lambda hit: float(hit[0].num_articles_since_2018 or 0) + 10000 * hit[1]
+        if limit:
+            return heapq.nlargest(limit, hits, key=score)
+        return sorted(hits, key=score, reverse=True)
+
+def load_journal_title_index():
+    return JournalTitleIndex(journal_catalog.get().journals.values())
+
+journal_title_index = register_dataset("journal_title_index",
+                                       load_journal_title_index,
+                                       depends_on=[journal_catalog])
+
+def search_journal_titles(q, limit=None):
+    return journal_title_index.get().search(q, limit)
+
+
+def is_mirror_journal_title(title):
+    return bool(title and title.lower().endswith(" x"))
+
+class JournalComplianceIndex(object):
+    # the plan-s rules from get_policy_dict, applied to every journal once per load
+    # so result lists can be filtered before any Journal objects are loaded
+    def __init__(self, rows):
+        self.num_articles_since_2018 = dict((row.issnl, row.num_articles_since_2018) for row in rows)
+        self.plan_s_gold_issnls = frozenset(
+            row.issnl for row in rows
+            if row.prop_cc_by_since_2018 >= THRESHOLD_PROP_CC_BY_SINCE_2018
+            and not is_mirror_journal_title(row.title)
+        )
+
+    def compliant_issnls(self, funder_id=None, institution=None):
+        # None when the funder's policy doesn't rule any journal out
+        if funder_registry.get_policy(funder_id) != "plan-s":
+            return None
+        extra_issnls = set(funder_specific_agreements.get(funder_id, []))
+        if institution:
+            for my_ta in transformative_agreement_index.get().covering_institution(institution):
+                extra_issnls.update(my_ta.covered_issnls)
+        return self.plan_s_gold_issnls | extra_issnls
+
+    def filter_compliant(self, issnls, funder_id=None, institution=None):
+        compliant_issnls = self.compliant_issnls(funder_id, institution)
+        if compliant_issnls is None:
+            return list(issnls)
+        return [issnl for issnl in issnls if issnl in compliant_issnls]
+
+    def most_recent_articles(self, issnls, n):
+        # the n journals with the most articles since 2018, skipping issnls we have no journal for
+        issnls = [issnl for issnl in issnls if issnl in self.num_articles_since_2018]
+        return heapq.nlargest(n, issnls, key=lambda issnl: self.num_articles_since_2018[issnl])
+
+def load_journal_compliance_index():
+    return JournalComplianceIndex(journal_catalog.get().journals.values())
+
+journal_compliance_index = register_dataset("journal_compliance_index",
+                                            load_journal_compliance_index,
+                                            depends_on=[journal_catalog])
+
+
+broad_oa_journal_issnls = ["1932-6203", "2041-1723", "2045-2322"]  # plos one, nature communications, scientific reports
+broad_oa_medicine_journal_issnls = ["2167-8359", "2046-1402"]  # peerj, f1000research
+
+class SimilarJournalIndex(object):
+    # per topic, the gold oa journals in sjr order, so the closest ones are a bisect away
+    def __init__(self, rows, issnls_by_topic):
+        journal_sjrs = dict((row.issnl, row.sjr) for row in rows)
+        gold_issnls = set(row.issnl for row in rows if row.prop_cc_by_since_2018 >= THRESHOLD_PROP_CC_BY_SINCE_2018)
+        self.sjrs_by_topic = {}
+        self.issnls_by_topic = {}
+        self.no_sjr_issnls_by_topic = {}
+        for (topic, topic_issnls) in issnls_by_topic.iteritems():
+            gold_topic_issnls = [issnl for issnl in topic_issnls if issnl in gold_issnls]
+            with_sjr = sorted((journal_sjrs[issnl], issnl) for issnl in gold_topic_issnls if journal_sjrs[issnl] is not None)
+            self.sjrs_by_topic[topic] = [sjr for (sjr, issnl) in with_sjr]
+            self.issnls_by_topic[topic] = [issnl for (sjr, issnl) in with_sjr]
+            self.no_sjr_issnls_by_topic[topic] = sorted(issnl for issnl in gold_topic_issnls if journal_sjrs[issnl] is None)
+        self.journal_issnls = set(journal_sjrs.keys())
+        self.cache = {}
+
+    def nearest_sjr(self, topic, my_issnl, my_sjr, n):
+        sjrs = self.sjrs_by_topic.get(topic, [])
+        issnls = self.issnls_by_topic.get(topic, [])
+        my_sjr = my_sjr or 0
+        picks = []
+        below = bisect.bisect_left(sjrs, my_sjr) - 1
+        above = below + 1
+        while len(picks) < n and (below >= 0 or above < len(sjrs)):
+            if above >= len(sjrs) or (below >= 0 and my_sjr - sjrs[below] <= sjrs[above] - my_sjr):
+                issnl = issnls[below]
+                below -= 1
+            else:
+                issnl = issnls[above]
+                above += 1
+            if issnl != my_issnl:
+                picks.append(issnl)
+        # journals without an sjr come last, like nulls in the old order by
+        for issnl in self.no_sjr_issnls_by_topic.get(topic, []):
+            if len(picks) >= n:
+                break
+            if issnl != my_issnl:
+                picks.append(issnl)
+        return picks
+
+    def similar_issnls(self, my_issnl, topic_names, my_sjr):
+        # four gold oa journals from the first topic with the closest sjr,
+        # topped up to five with broad oa journals
+        if my_issnl not in self.cache:
+            issnls = []
+            if topic_names:
+                issnls = self.nearest_sjr(topic_names[0], my_issnl, my_sjr, 4)
+            broad_issnls = broad_oa_journal_issnls
+            if "medicine" in u",".join([t.lower() for t in topic_names]):
+                broad_issnls = broad_issnls + broad_oa_medicine_journal_issnls
+            for issnl in broad_issnls:
+                if len(issnls) >= 5:
+                    break
+                if issnl not in issnls and issnl != my_issnl and issnl in self.journal_issnls:
+                    issnls.append(issnl)
+            self.cache[my_issnl] = issnls
+        return self.cache[my_issnl]
+
+def load_similar_journal_index():
+    return SimilarJournalIndex(journal_catalog.get().journals.values(), topic_index.get().issnls_by_topic)
+
+similar_journal_index = register_dataset("similar_journal_index",
+                                         load_similar_journal_index,
+                                         depends_on=[journal_catalog, topic_index])
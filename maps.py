@@ -0,0 +1,273 @@
+import json
+import math
+
+from datasets import register_dataset
+from datasets import files_version
+
+
+# the world-*.json files are already TopoJSON, quantized finely enough to print a wall map.
+# the dashboard maps are a few hundred pixels wide, so we serve them simplified and
+# requantized: arcs are still shared between neighbours, so borders stay watertight.
+#
+# tolerance is in degrees, quantization is the number of grid steps across each axis,
+# and islands smaller than min_area square degrees are left out (a country always keeps
+# its biggest polygon, unless it rounds away to nothing)
+map_resolutions = {
+    "high": {"tolerance": 0.05, "quantization": 10000, "min_area": 0},
+    "medium": {"tolerance": 0.3, "quantization": 2000, "min_area": 0.5},
+    "low": {"tolerance": 0.5, "quantization": 1000, "min_area": 2},
+}
+# medium is the lightest that still draws every country; ?resolution=full is the original file
+default_map_resolution = "medium"
+
+map_filenames = {
+    "continent": "data/world-continents.json",
+    "country": "data/world-countries-sans-antarctica.json",
+}
+
+
+def decode_arcs(topology):
+    # quantized, delta-encoded arcs -> lists of absolute (lng, lat) points
+    (scale_x, scale_y) = topology["transform"]["scale"]
+    (translate_x, translate_y) = topology["transform"]["translate"]
+    arcs = []
+    for arc in topology["arcs"]:
+        x = 0
+        y = 0
+        points = []
+        for (dx, dy) in arc:
+            x += dx
+            y += dy
+            points.append((x * scale_x + translate_x, y * scale_y + translate_y))
+        arcs.append(points)
+    return arcs
+
+
+def distance_to_segment(point, start, end):
+    (x, y) = point
+    (x1, y1) = start
+    (x2, y2) = end
+    dx = x2 - x1
+    dy = y2 - y1
+    if dx == 0 and dy == 0:
+        return math.hypot(x - x1, y - y1)
+    t = ((x - x1) * dx + (y - y1) * dy) / float(dx * dx + dy * dy)
+    t = max(0.0, min(1.0, t))
+    return math.hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+
+def mark_douglas_peucker(points, first, last, tolerance, keep):
+    # iterative, some coastlines are long enough to hit the recursion limit
+    stack = [(first, last)]
+    while stack:
+        (first, last) = stack.pop()
+        if last - first < 2:
+            continue
+        max_distance = -1
+        max_index = None
+        for i in range(first + 1, last):
+            distance = distance_to_segment(points[i], points[first], points[last])
+            if distance > max_distance:
+                max_distance = distance
+                max_index = i
+        if max_distance > tolerance:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+
+
+def simplify_arc(points, tolerance):
+    if len(points) <= 2:
+        return points
+    keep = [False] * len(points)
+    keep[0] = True
+    keep[-1] = True
+    if points[0] == points[-1]:
+        # an arc that is a whole ring (an island) has to keep enough points to stay a ring
+        far_index = max(range(1, len(points) - 1), key=lambda i: distance_to_segment(points[i], points[0], points[0]))
+        keep[far_index] = True
+        other_indexes = [i for i in range(1, len(points) - 1) if i != far_index]
+        if other_indexes:
+            keep[max(other_indexes, key=lambda i: distance_to_segment(points[i], points[0], points[far_index]))] = True
+        mark_douglas_peucker(points, 0, far_index, tolerance, keep)
+        mark_douglas_peucker(points, far_index, len(points) - 1, tolerance, keep)
+    else:
+        mark_douglas_peucker(points, 0, len(points) - 1, tolerance, keep)
+    return [point for (point, is_kept) in zip(points, keep) if is_kept]
+
+
+def quantize_arc(points, translate, scale):
+    # absolute points -> absolute integer grid points
+    (translate_x, translate_y) = translate
+    (scale_x, scale_y) = scale
+    return [(int(round((x - translate_x) / scale_x)), int(round((y - translate_y) / scale_y))) for (x, y) in points]
+
+
+def encode_arc(points):
+    # absolute integer points -> delta-encoded, dropping steps that round to nothing
+    encoded = []
+    previous_x = 0
+    previous_y = 0
+    for (i, (quantized_x, quantized_y)) in enumerate(points):
+        dx = quantized_x - previous_x
+        dy = quantized_y - previous_y
+        is_endpoint = i == 0 or i == len(points) - 1
+        if dx == 0 and dy == 0 and not is_endpoint:
+            continue
+        encoded.append([dx, dy])
+        previous_x = quantized_x
+        previous_y = quantized_y
+    return encoded
+
+
+def get_ring_points(ring, arcs):
+    points = []
+    for arc_index in ring:
+        if arc_index >= 0:
+            arc_points = arcs[arc_index]
+        else:
+            arc_points = arcs[~arc_index][::-1]
+        points += arc_points if not points else arc_points[1:]
+    return points
+
+
+def get_ring_area(ring, arcs):
+    points = get_ring_points(ring, arcs)
+    area = 0.0
+    for ((x1, y1), (x2, y2)) in zip(points, points[1:]):
+        area += x1 * y2 - x2 * y1
+    return abs(area) / 2
+
+
+def drop_small_polygons(geometry, arcs, min_area):
+    if geometry.get("type") != "MultiPolygon" or not min_area:
+        return geometry
+    polygons = geometry["arcs"]
+    kept = [polygon for polygon in polygons if get_ring_area(polygon[0], arcs) >= min_area]
+    if not kept:
+        kept = [max(polygons, key=lambda polygon: get_ring_area(polygon[0], arcs))]
+    return dict(geometry, arcs=kept)
+
+
+def is_degenerate_ring(ring, arcs):
+    # a ring that rounds down to fewer than 3 distinct points can't be drawn
+    return len(set(get_ring_points(ring, arcs))) < 3
+
+
+def drop_degenerate_rings(geometry, arcs):
+    # holes that collapse are dropped, and so are polygons whose outer ring collapses.
+    # a geometry with nothing left becomes a null geometry, keeping its id and properties
+    if geometry.get("type") == "Polygon":
+        polygons = [geometry["arcs"]]
+    elif geometry.get("type") == "MultiPolygon":
+        polygons = geometry["arcs"]
+    else:
+        return geometry
+    kept = []
+    for polygon in polygons:
+        if is_degenerate_ring(polygon[0], arcs):
+            continue
+        kept.append([polygon[0]] + [ring for ring in polygon[1:] if not is_degenerate_ring(ring, arcs)])
+    if not kept:
+        null_geometry = dict(geometry, type=None)
+        del null_geometry["arcs"]
+        return null_geometry
+    if geometry["type"] == "Polygon":
+        return dict(geometry, arcs=kept[0])
+    return dict(geometry, arcs=kept)
+
+
+def get_geometry_arc_indexes(geometry):
+    if geometry.get("type") == "Polygon":
+        rings = geometry["arcs"]
+    elif geometry.get("type") == "MultiPolygon":
+        rings = [ring for polygon in geometry["arcs"] for ring in polygon]
+    else:
+        rings = []
+    return [arc_index if arc_index >= 0 else ~arc_index for ring in rings for arc_index in ring]
+
+
+def renumber_geometry_arcs(geometry, new_indexes):
+    renumber = lambda ring: [new_indexes[i] if i >= 0 else ~new_indexes[~i] for i in ring]
+    if geometry.get("type") == "Polygon":
+        return dict(geometry, arcs=[renumber(ring) for ring in geometry["arcs"]])
+    if geometry.get("type") == "MultiPolygon":
+        return dict(geometry, arcs=[[renumber(ring) for ring in polygon] for polygon in geometry["arcs"]])
+    return geometry
+
+
+def get_bounds(arcs):
+    xs = [x for arc in arcs for (x, y) in arc]
+    ys = [y for arc in arcs for (x, y) in arc]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def get_used_arc_indexes(objects):
+    return sorted(set(
+        arc_index
+        for geometry_collection in objects.values()
+        for geometry in geometry_collection["geometries"]
+        for arc_index in get_geometry_arc_indexes(geometry)
+    ))
+
+
+def simplify_topology(topology, tolerance, quantization, min_area=0):
+    arcs = [simplify_arc(arc, tolerance) for arc in decode_arcs(topology)]
+
+    objects = {}
+    for (object_name, geometry_collection) in topology["objects"].iteritems():
+        geometries = [drop_small_polygons(geometry, arcs, min_area) for geometry in geometry_collection["geometries"]]
+        objects[object_name] = dict(geometry_collection, geometries=geometries)
+
+    (min_x, min_y, max_x, max_y) = get_bounds([arcs[arc_index] for arc_index in get_used_arc_indexes(objects)])
+    translate = [min_x, min_y]
+    scale = [
+        (max_x - min_x) / (quantization - 1) or 1,
+        (max_y - min_y) / (quantization - 1) or 1,
+    ]
+    quantized_arcs = [quantize_arc(arc, translate, scale) for arc in arcs]
+    for geometry_collection in objects.values():
+        geometry_collection["geometries"] = [drop_degenerate_rings(geometry, quantized_arcs) for geometry in geometry_collection["geometries"]]
+
+    # arcs nothing points at any more are dropped, the rest are renumbered
+    used_arc_indexes = get_used_arc_indexes(objects)
+    new_indexes = dict((old_index, new_index) for (new_index, old_index) in enumerate(used_arc_indexes))
+    for geometry_collection in objects.values():
+        geometry_collection["geometries"] = [renumber_geometry_arcs(geometry, new_indexes) for geometry in geometry_collection["geometries"]]
+
+    simplified = {
+        "type": "Topology",
+        "transform": {"scale": scale, "translate": translate},
+        "objects": objects,
+        "arcs": [encode_arc(quantized_arcs[arc_index]) for arc_index in used_arc_indexes],
+    }
+    if "bbox" in topology:
+        simplified["bbox"] = topology["bbox"]
+    return simplified
+
+
+def load_map(map_name):
+    with open(map_filenames[map_name]) as f:
+        topology = json.load(f)
+    payloads = {"full": json.dumps(topology, separators=(",", ":"))}
+    for (resolution, params) in map_resolutions.iteritems():
+        simplified = simplify_topology(topology, params["tolerance"], params["quantization"], params["min_area"])
+        payloads[resolution] = json.dumps(simplified, separators=(",", ":"))
+    return payloads
+
+
+map_datasets = {}
+for map_name in map_filenames:
+    map_datasets[map_name] = register_dataset(
+        u"map_{}".format(map_name),
+        lambda map_name=map_name: load_map(map_name),
+        version=lambda map_name=map_name: files_version([map_filenames[map_name]])
+    )
+
+
+def get_map_json(map_name, resolution=None):
+    payloads = map_datasets[map_name].get()
+    resolution = resolution or default_map_resolution
+    if resolution not in payloads:
+        raise ValueError(u"unknown resolution {}, try one of: {}".format(resolution, u", ".join(sorted(payloads.keys()))))
+    return payloads[resolution]
@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+
+
+# name -> the PrefixCache currently in use, for /ready
+all_prefix_caches = OrderedDict()
+
+
+class PrefixCache(object):
+    """
+    Candidate sets for autocomplete queries, least recently used first out.
+
+    Clients send "b", "bi", "bio"... one after another.  When "bio" isn't cached but
+    "bi" is, and the caller says "bio" can only narrow what "bi" matched, we filter
+    the "bi" candidates instead of searching the whole index again.  Each index owns
+    its cache, so a reloaded index starts with an empty one.
+    """
+
+    def __init__(self, name, max_entries=1000, max_candidates=10000):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        all_prefix_caches[name] = self
+
+    def _get_entry(self, key):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def _store(self, key, context, candidates):
+        if len(candidates) > self.max_candidates:
+            return
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (context, candidates)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def lookup(self, key, context, build, refine, narrows=None):
+        """
+        The candidates for key.
+
+        build() searches from scratch.  refine(candidates) filters the candidates of a
+        shorter prefix down to this key's.  narrows(cached_context), when given, says
+        whether this query can only match a subset of what that prefix matched; context
+        is what gets handed to it for later, longer keys.
+        """
+        entry = self._get_entry(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+
+        for end in range(len(key) - 1, 0, -1):
+            entry = self._get_entry(key[:end])
+            if entry is None:
+                continue
+            (cached_context, cached_candidates) = entry
+            if narrows and not narrows(cached_context):
+                continue
+            self.prefix_hits += 1
+            candidates = refine(cached_candidates)
+            self._store(key, context, candidates)
+            return candidates
+
+        self.misses += 1
+        candidates = build()
+        self._store(key, context, candidates)
+        return candidates
+
+    def to_dict(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "prefix_hits": self.prefix_hits,
+            "misses": self.misses
+        }
+
+
+def prefix_cache_stats():
+    return OrderedDict((name, cache.to_dict()) for (name, cache) in all_prefix_caches.iteritems())
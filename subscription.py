@@ -0,0 +1,227 @@
+import json
+import datetime
+import threading
+from collections import OrderedDict
+
+from app import get_db_cursor
+from datasets import DatasetFamily
+from util import to_unicode_or_bust
+
+
+def get_subscription_rows(package="cdl_elsevier"):
+
+    command = "select * from ricks_unpaywall_journals_subscription_agg where package_id = %s"
+
+    with get_db_cursor() as cursor:
+        cursor.execute(command, (package,))
+        rows = cursor.fetchall()
+    return rows
+
+def display_closed_access_downloads(row):
+    if not row["num_papers"] or not ["num_is_oa"] or not row["mit_counter_age_0y"]:
+        return None
+
+    percent_closed = 1 - float(row["num_is_oa"])/row["num_papers"]
+    num_downloads = float(row["mit_counter_age_0y"])
+    closed_access_downloads = percent_closed * num_downloads
+    if closed_access_downloads > 190:
+        return "high"
+    if closed_access_downloads > 50:
+        return "medium"
+    return "low"
+
+def display_downloads(row):
+    num_downloads = row["mit_counter_age_0y"]
+    if num_downloads > 250:
+        return "high"
+    if num_downloads > 67:
+        return "medium"
+    return "low"
+
+def prepare_subscription(row, package):
+    my_dict = {
+        "issnl": row["journal_issn_l"],
+        "journal_issn_l": row["journal_issn_l"],
+        "journal_name": row["title"],
+        # "publisher": row["publisher"],
+        "affected_start_date": row["from_date"],
+        "affected_end_date": row["to_date"],
+        "num_dois": row["num_papers"],
+        "num_oa": row["num_is_oa"],
+        "proportion_publisher_hosted": round(float(row["num_publisher_hosted"]) / row["num_papers"], 4),
+        "proportion_repository_hosted": round(float(row["num_repository_hosted"]) / row["num_papers"], 4),
+        "proportion_oa": round(float(row["num_is_oa"]) / row["num_papers"], 4),
+        "issns": json.loads(row["issns"]),
+        "score": row["num_papers"]
+    }
+    if my_dict["affected_start_date"]:
+        if my_dict["affected_start_date"].isoformat()[0:10].endswith('12-31'):
+            my_dict["affected_start_date"] = my_dict["affected_start_date"] + datetime.timedelta(days=1)
+        my_dict["affected_start_date"] = my_dict["affected_start_date"].isoformat()[0:10]
+    if my_dict["affected_end_date"]:
+        my_dict["affected_end_date"] = my_dict["affected_end_date"].isoformat()[0:10]
+    if package == "mit_elsevier":
+        my_dict.update({
+        "closed_access_downloads": display_closed_access_downloads(row),
+        "downloads": display_downloads(row),
+        "num_citations": row["mit_num_citations"] if row["mit_num_citations"] else 0,
+        })
+    return my_dict
+
+
+breakdown_keys = [
+    "num_papers",
+    "num_is_oa",
+    "num_publisher_hosted",
+    "num_repository_hosted",
+    "num_has_repository_hosted_and_has_publisher_hosted",
+    "num_has_repository_hosted_and_not_publisher_hosted",
+    "num_not_repository_hosted_and_has_publisher_hosted",
+]
+
+def sum_rows(rows):
+    # every count /breakdown needs, in one pass over the rows
+    totals = dict((key, 0) for key in breakdown_keys)
+    for row in rows:
+        for key in breakdown_keys:
+            totals[key] += row[key] or 0
+    return totals
+
+def get_breakdown(rows, totals):
+    return {
+        "article_breakdown": {
+            "num_closed": totals["num_papers"] - totals["num_is_oa"],
+            "num_has_repository_hosted_and_has_publisher_hosted": totals["num_has_repository_hosted_and_has_publisher_hosted"],
+            "num_has_repository_hosted_and_not_publisher_hosted": totals["num_has_repository_hosted_and_not_publisher_hosted"],
+            "num_not_repository_hosted_and_has_publisher_hosted": totals["num_not_repository_hosted_and_has_publisher_hosted"]
+        },
+        "num_articles_total": totals["num_papers"],
+        "num_journals_total": len(rows),
+    }
+
+def get_oa_host_breakdown(totals):
+    # "any" and "closed" split the articles, publisher and repository overlap
+    return [
+        {"oa_host": "any", "num_articles": totals["num_is_oa"]},
+        {"oa_host": "publisher", "num_articles": totals["num_publisher_hosted"]},
+        {"oa_host": "repository", "num_articles": totals["num_repository_hosted"]},
+        {"oa_host": "closed", "num_articles": totals["num_papers"] - totals["num_is_oa"]},
+    ]
+
+def get_year_breakdown(package):
+    command = """
+        select extract(year from u.published_date)::int as year, u.oa_status, count(*) as num_articles
+        from unpaywall_production u
+        join ricks_unpaywall_journals_subscription_agg j on u.journal_issn_l = j.journal_issn_l
+        where
+            package_id = %s and
+            u.published_date >= coalesce(j.from_date, '1900-01-01'::timestamp) and u.published_date < coalesce(j.to_date, '2100-01-01'::timestamp)
+        group by 1, 2
+    """
+    with get_db_cursor() as cursor:
+        cursor.execute(command, (package,))
+        rows = cursor.fetchall()
+
+    years = {}
+    for row in rows:
+        year = years.setdefault(row["year"], {"year": row["year"], "num_articles": 0, "num_closed": 0, "num_by_oa_status": {}})
+        year["num_articles"] += row["num_articles"]
+        if row["oa_status"] == "closed":
+            year["num_closed"] += row["num_articles"]
+        year["num_by_oa_status"][row["oa_status"]] = row["num_articles"]
+    return sorted(years.values(), key=lambda k: k["year"])
+
+
+max_article_counts = 1000
+
+
+class SubscriptionModel(object):
+    """
+    One package's subscription rows, prepared once per data version.
+
+    Holds the raw rows, the /breakdown totals, the prepared subscriptions in score
+    order, an issn index and the lowercased titles, so the /subscription* endpoints
+    and /breakdown are lookups and filters over memory instead of a refetch per request.
+    """
+
+    def __init__(self, package, rows):
+        self.package = package
+        self.rows = rows
+        totals = sum_rows(rows)
+        self.totals = totals
+        self.breakdown = get_breakdown(rows, totals)
+        self.oa_host_breakdown = get_oa_host_breakdown(totals)
+        self._year_breakdown = None
+        self._article_counts = OrderedDict()
+        self._article_counts_lock = threading.Lock()
+        self.subscriptions = sorted([prepare_subscription(row, package) for row in rows], key=lambda k: k['score'], reverse=True)
+        self.subscriptions_by_issn = {}
+        for subscription in self.subscriptions:
+            for issn in subscription["issns"]:
+                self.subscriptions_by_issn.setdefault(issn, subscription)
+        self.lowercase_titles = [to_unicode_or_bust(subscription["journal_name"]).lower() for subscription in self.subscriptions]
+
+    def get_by_issn(self, issn):
+        return self.subscriptions_by_issn.get(to_unicode_or_bust(issn).lower())
+
+    def search_titles(self, q):
+        lowercase_q = to_unicode_or_bust(q).lower()
+        return [subscription for (subscription, title) in zip(self.subscriptions, self.lowercase_titles) if lowercase_q in title]
+
+    def get_article_count(self, filters):
+        # exact /articles counts already paid for, by filter, until the package data changes
+        with self._article_counts_lock:
+            count = self._article_counts.pop(filters, None)
+            if count is not None:
+                self._article_counts[filters] = count
+            return count
+
+    def set_article_count(self, filters, count):
+        with self._article_counts_lock:
+            self._article_counts.pop(filters, None)
+            self._article_counts[filters] = count
+            while len(self._article_counts) > max_article_counts:
+                self._article_counts.popitem(last=False)
+
+    def get_year_breakdown(self):
+        # one aggregate query, the first time a dashboard asks for it in this data version
+        if self._year_breakdown is None:
+            self._year_breakdown = get_year_breakdown(self.package)
+        return self._year_breakdown
+
+
+def get_subscription_version(package):
+    # (number of journals, a checksum over every column of every row), so a reload that
+    # changes any value the model serves moves it.  cheap next to fetching the rows
+    with get_db_cursor() as cursor:
+        cursor.execute("select column_name from information_schema.columns where table_name = 'ricks_unpaywall_journals_subscription_agg' order by ordinal_position")
+        column_names = [row["column_name"] for row in cursor.fetchall()]
+        row_text = u" || '|' || ".join(u"coalesce(cast(\"{}\" as varchar), '')".format(column_name) for column_name in column_names)
+        command = u"""
+            select count(*) as num_journals, sum(strtol(left(md5({row_text}), 8), 16)) as checksum
+            from ricks_unpaywall_journals_subscription_agg where package_id = %s
+        """.format(row_text=row_text)
+        cursor.execute(command, (package,))
+        row = cursor.fetchone()
+    return (row["num_journals"], row["checksum"])
+
+def load_subscription_model(package):
+    return SubscriptionModel(package, get_subscription_rows(package))
+
+# the version check catches reloads, the refresh is a backstop in case one slips past it
+subscription_models = DatasetFamily("subscriptions",
+                                    load_subscription_model,
+                                    version=get_subscription_version,
+                                    refresh_seconds=6 * 60 * 60,
+                                    max_entries=20)
+
+def get_subscription_model(package):
+    # only packages that exist get cached, so a made-up ?package= can't push real ones out
+    if package not in subscription_models:
+        (num_journals, checksum) = get_subscription_version(package)
+        if not num_journals:
+            return SubscriptionModel(package, [])
+    return subscription_models.get(package)
+
+def get_subscriptions(package):
+    return get_subscription_model(package).subscriptions
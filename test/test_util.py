@@ -0,0 +1,32 @@
+import base64
+import datetime
+import json
+import unittest
+
+from util import decode_cursor
+from util import encode_cursor
+
+
+def tampered_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+class TestCursors(unittest.TestCase):
+
+    def test_round_trip(self):
+        cursor = encode_cursor([datetime.date(2020, 1, 2), u"10.1234/abc"])
+        self.assertEqual(decode_cursor(cursor, num_values=2), [u"2020-01-02", u"10.1234/abc"])
+        self.assertEqual(decode_cursor(encode_cursor([u"0000-0001"])), [u"0000-0001"])
+
+    def test_not_a_cursor(self):
+        for cursor in [u"", u"not base64!", base64.urlsafe_b64encode("not json"), u"\u00e9"]:
+            self.assertRaises(ValueError, decode_cursor, cursor)
+
+    def test_tampered_cursor(self):
+        for values in [42, None, u"0000-0001", {"after": u"0000-0001"}, [], [42], [None], [[u"0000-0001"]]]:
+            self.assertRaises(ValueError, decode_cursor, tampered_cursor(values))
+
+    def test_wrong_length(self):
+        self.assertRaises(ValueError, decode_cursor, tampered_cursor([u"a", u"b"]))
+        self.assertRaises(ValueError, decode_cursor, tampered_cursor([u"a"]), num_values=2)
+        self.assertRaises(ValueError, decode_cursor, tampered_cursor([u"a", 42]), num_values=2)
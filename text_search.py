@@ -0,0 +1,219 @@
+import re
+import math
+import bisect
+from collections import defaultdict
+
+from prefix_cache import PrefixCache
+
+
+# an in-memory stand-in for the postgres full text search the autocomplete endpoints used:
+#   to_tsvector('only_stop_words', text) @@ to_tsquery('only_stop_words', 'word & word & prefix:*')
+# ranked with ts_rank_cd(..., 1).  'only_stop_words' (see bq_transfer.sql) is the simple
+# config, lowercasing everything, with the english stop words taken out of plain ascii words.
+
+# postgres share/tsearch_data/english.stop
+english_stop_words = set(u"""
+    i me my myself we our ours ourselves you your yours yourself yourselves he him his himself
+    she her hers herself it its itself they them their theirs themselves what which who whom
+    this that these those am is are was were be been being have has had having do does did
+    doing a an the and but if or because as until while of at by for with about against between
+    into through during before after above below to from up down in out on off over under again
+    further then once here there when where why how all any both each few more most other some
+    such no nor not only own same so than too very s t can will just don should now
+    """.split())
+
+word_pattern = re.compile(ur"\d+(?:\.\d+)+|[^\W_]+(?:-[^\W_]+)*", re.UNICODE)
+ascii_word_pattern = re.compile(r"^[a-z]+$")
+
+
+def tokenize(text):
+    # returns (lexeme, position) pairs.  like to_tsvector, stop words use up a position,
+    # and a hyphenated word is indexed whole and then part by part.
+    tokens = []
+    position = 0
+    for match in word_pattern.finditer(text.lower()):
+        word = match.group(0)
+        words = [word]
+        if u"-" in word:
+            words += word.split(u"-")
+        for word in words:
+            position += 1
+            if len(words) == 1 and ascii_word_pattern.match(word) and word in english_stop_words:
+                continue
+            tokens.append((word, position))
+    return tokens
+
+
+def parse_query(q):
+    # mirrors the to_tsquery string the endpoints used to build: drop tsquery operators,
+    # AND together the whitespace separated words, and let the last one match as a prefix.
+    # words that are only stop words drop out, the way to_tsquery drops them.
+    operands = re.sub(ur"[!'()|&]", u" ", q).split()
+    items = []
+    for (i, operand) in enumerate(operands):
+        is_prefix = (i == len(operands) - 1)
+        for (lexeme, position) in tokenize(operand):
+            if (lexeme, is_prefix) not in items:
+                items.append((lexeme, is_prefix))
+    return items
+
+
+def item_implies(item, other_item):
+    # does a doc that has item always have other_item?
+    (lexeme, is_prefix) = item
+    (other_lexeme, other_is_prefix) = other_item
+    if other_is_prefix:
+        return lexeme.startswith(other_lexeme)
+    return lexeme == other_lexeme and not is_prefix
+
+
+def items_narrow(items, other_items):
+    # can the docs matching items only be a subset of the docs matching other_items?
+    # not a given for a longer query: "of" parses to nothing and matches nothing,
+    # while "oft" matches plenty
+    if not other_items:
+        return False
+    return all(any(item_implies(item, other_item) for item in items) for other_item in other_items)
+
+
+def name_match_score(q, names):
+    # how closely q matches the best of names, 0 to 1, comparable across entity types:
+    # the whole name, the start of it, the start of one of its words, or anything else
+    # the search matched on (a later word, an alternate spelling)
+    clean = lambda text: re.sub(ur"[\W_]+", u" ", (text or u"").lower(), flags=re.UNICODE).strip()
+    clean_q = clean(q)
+    best = 0.4
+    for name in names:
+        clean_name = clean(name)
+        if not clean_q or not clean_name:
+            continue
+        if clean_name == clean_q:
+            return 1.0
+        if clean_name.startswith(clean_q):
+            best = max(best, 0.8)
+        elif (u" " + clean_name).find(u" " + clean_q) >= 0:
+            best = max(best, 0.6)
+    return best
+
+
+def autocomplete_score(q, names, popularity, max_popularity):
+    # 0 to 1, so results of different entity types can be ranked in one list: mostly how
+    # well the name matches, then how big the thing is next to the biggest of its type
+    if max_popularity and popularity:
+        popularity_score = min(1.0, math.log1p(float(popularity)) / math.log1p(float(max_popularity)))
+    else:
+        popularity_score = 0.0
+    return round(0.6 * name_match_score(q, names) + 0.4 * popularity_score, 5)
+
+
+class TextIndex(object):
+    def __init__(self, docs, cache_name=None):
+        # docs is an iterable of (key, text)
+        self.positions = {}
+        self.lengths = {}
+        self.postings = defaultdict(set)
+        for (key, text) in docs:
+            doc_positions = defaultdict(list)
+            tokens = tokenize(text or u"")
+            for (lexeme, position) in tokens:
+                doc_positions[lexeme].append(position)
+                self.postings[lexeme].add(key)
+            self.positions[key] = dict(doc_positions)
+            self.lengths[key] = len(tokens)
+        self.postings = dict(self.postings)
+        self.lexemes = sorted(self.postings.keys())
+        self.cache = PrefixCache(cache_name) if cache_name else None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def matching_lexemes(self, item):
+        (lexeme, is_prefix) = item
+        if not is_prefix:
+            return [lexeme] if lexeme in self.postings else []
+        start = bisect.bisect_left(self.lexemes, lexeme)
+        end = bisect.bisect_left(self.lexemes, lexeme + u"\uffff")
+        return self.lexemes[start:end]
+
+    def match(self, items):
+        # keys of the docs that have every item
+        if not items:
+            return set()
+        doc_sets = []
+        for item in items:
+            docs = set()
+            for lexeme in self.matching_lexemes(item):
+                docs |= self.postings[lexeme]
+            if not docs:
+                return set()
+            doc_sets.append(docs)
+        doc_sets.sort(key=len)
+        return doc_sets[0].intersection(*doc_sets[1:])
+
+    def has_items(self, key, items):
+        doc_lexemes = self.positions[key]
+        for (lexeme, is_prefix) in items:
+            if is_prefix:
+                if not any(doc_lexeme.startswith(lexeme) for doc_lexeme in doc_lexemes):
+                    return False
+            elif lexeme not in doc_lexemes:
+                return False
+        return True
+
+    def rank(self, key, items):
+        # ts_rank_cd with normalization 1: sums 0.1 / (1 + noise words) over the covers,
+        # the shortest stretches of the text that contain every item, divided by
+        # log(1 + number of lexemes)
+        item_positions = defaultdict(set)
+        for (item_index, item) in enumerate(items):
+            (lexeme, is_prefix) = item
+            for (doc_lexeme, positions) in self.positions[key].iteritems():
+                if doc_lexeme == lexeme or (is_prefix and doc_lexeme.startswith(lexeme)):
+                    for position in positions:
+                        item_positions[position].add(item_index)
+        doc = sorted(item_positions.items())
+        num_items = len(items)
+
+        rank = 0.0
+        start = 0
+        while start < len(doc):
+            end = None
+            found = set()
+            for i in range(start, len(doc)):
+                found |= doc[i][1]
+                if len(found) == num_items:
+                    end = i
+                    break
+            if end is None:
+                break
+            begin = end
+            found = set()
+            for i in range(end, start - 1, -1):
+                found |= doc[i][1]
+                if len(found) == num_items:
+                    begin = i
+                    break
+            num_noise = (doc[end][0] - doc[begin][0]) - (end - begin)
+            if num_noise < 0:
+                num_noise = (end - begin) / 2
+            rank += 0.1 / (1 + num_noise)
+            start = begin + 1
+
+        if self.lengths[key]:
+            rank /= math.log(self.lengths[key] + 1)
+        return rank
+
+    def search(self, q):
+        # (key, rank) for every doc matching the query, unordered
+        items = parse_query(q)
+        if self.cache:
+            keys = self.cache.lookup(
+                q.lower(),
+                items,
+                build=lambda: list(self.match(items)),
+                refine=lambda keys: [key for key in keys if self.has_items(key, items)],
+                narrows=lambda cached_items: items_narrow(items, cached_items)
+            )
+        else:
+            keys = self.match(items)
+        return [(key, self.rank(key, items)) for key in keys]
@@ -1,4 +1,10 @@
+import heapq
+from collections import defaultdict
+
 from app import db
+from datasets import register_dataset
+from datasets import table_version
+from text_search import TextIndex
 
 class Topic(db.Model):
     __tablename__ = 'bq_scimago_issnl_topics'
@@ -14,3 +20,66 @@ class Topic(db.Model):
         return response
 
 
+class TopicRecord(object):
+    # a Topic row as held by the journal catalog
+    __slots__ = ("topic", "quadrant")
+
+    def __init__(self, topic, quadrant):
+        self.topic = topic
+        self.quadrant = quadrant
+
+    def to_dict(self):
+        response = [self.topic, self.quadrant]
+        return response
+
+
+class TopicIndex(object):
+    # topic membership and per-topic totals, worked out once per load rather than
+    # on every topic page and autocomplete keystroke
+    def __init__(self, rows):
+        # rows are (topic, issnl, num_articles_3years)
+        self.num_total_3years = defaultdict(int)
+        journals_by_topic = defaultdict(list)
+        for (topic, issnl, num_articles_3years) in rows:
+            self.num_total_3years[topic] += num_articles_3years or 0
+            journals_by_topic[topic].append((num_articles_3years, issnl))
+        self.num_total_3years = dict(self.num_total_3years)
+        self.max_num_total_3years = max(self.num_total_3years.values() or [0])
+        self.issnls_by_topic = dict(
+            (topic, [issnl for (num_articles_3years, issnl) in sorted(journals, reverse=True)])
+            for (topic, journals) in journals_by_topic.iteritems()
+        )
+        self.text_index = TextIndex(((topic, topic) for topic in self.num_total_3years), cache_name="topics")
+
+    def journal_issnls(self, topic, limit=None):
+        # issnls in the topic, most num_articles_3years first
+        issnls = self.issnls_by_topic.get(topic, [])
+        if limit:
+            return issnls[:limit]
+        return list(issnls)
+
+    def search(self, q, limit=None):
+        # (topic, num_total_3years, fulltext rank), best first by num_total_3years + 100000 * rank
+        hits = [(topic, self.num_total_3years[topic], rank) for (topic, rank) in self.text_index.search(q)]
+        score = lambda hit: float(hit[1] or 0) + 100000 * hit[2]
+        if limit:
+            return heapq.nlargest(limit, hits, key=score)
+        return sorted(hits, key=score, reverse=True)
+
+def load_topic_index():
+    rows = db.session.query(
+        Topic.topic,
+        Topic.issnl,
+        Topic.num_articles_3years
+    ).all()
+    return TopicIndex(rows)
+
+topic_index = register_dataset("topic_index",
+                               load_topic_index,
+                               version=lambda: table_version("bq_scimago_issnl_topics"))
+
+def search_topics(q, limit=None):
+    return topic_index.get().search(q, limit)
+
+def get_topic_journal_issnls(topic, limit=None):
+    return topic_index.get().journal_issnls(topic, limit)
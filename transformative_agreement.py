@@ -1,6 +1,13 @@
+import bisect
+from collections import defaultdict
 from sqlalchemy import orm
+from sqlalchemy import sql
+from app import app
 from app import db
 from institution import Institution
+from util import encode_cursor
+
+default_matches_page_size = 100
 
 class TransformativeAgreementIssnlMatches(db.Model):
     __tablename__ = 'bq_transformative_agreement_issnl_matches'
@@ -39,36 +46,87 @@ class TransformativeAgreement(db.Model):
 
 
     @property
-    def journals_list(self):
-        from journal import Journal
-
-        issnls =  [obj.issnl for obj in self.issnl_matches]
-        journals = Journal.query.filter(Journal.issnl.in_(issnls)).options(orm.noload("*")).all()
-        journal_dicts = [{"id": j.issnl, "name": j.title} for j in journals]
-        return journal_dicts
+    def matched_issnls(self):
+        # sorted, and only the issnls the journal catalog has, so pages come back full
+        # and num_journals agrees with what paging through them returns
+        from journal import journal_catalog
 
+        catalog = journal_catalog.get()
+        cached = getattr(self, "_matched_issnls", None)
+        if cached is None or cached[0] is not catalog:
+            issnls = sorted(set(match.issnl for match in self.issnl_matches if catalog.get(match.issnl)))
+            self._matched_issnls = (catalog, issnls)
+        return self._matched_issnls[1]
 
     @property
-    def institutions_list(self):
-        institutions = []
+    def num_journals(self):
+        return len(self.matched_issnls)
+
+    def get_journals_page(self, after=None, page_size=default_matches_page_size):
+        # (journal dicts, last issnl on the page or None when there are no more), in issnl order
+        from journal import journal_catalog
+
+        issnls = self.matched_issnls
+        start = bisect.bisect_right(issnls, after) if after else 0
+        page_issnls = issnls[start:start + page_size]
+        next_after = page_issnls[-1] if start + page_size < len(issnls) else None
+        journal_dicts = [{"id": j.issnl, "name": j.title} for j in journal_catalog.get().get_many(page_issnls)]
+        return (journal_dicts, next_after)
+
+    def get_institutions_query(self):
         if self.grid_id:
-            institutions = Institution.query.filter(Institution.grid_id==self.grid_id).options(orm.noload("*")).all()
+            return Institution.query.filter(Institution.grid_id==self.grid_id)
         elif self.country_code:
-            institutions = Institution.query.filter(Institution.country_code==self.country_code).options(orm.noload("*")).all()
-        institution_dicts = [{"id": inst.grid_id, "name": inst.org_name} for inst in institutions]
-        return institution_dicts
+            return Institution.query.filter(Institution.country_code==self.country_code)
+        return None
 
-    def applies(self, issnl, to_this_institution):
-        if (self.grid_id and self.grid_id != to_this_institution.grid_id):
+    @property
+    def num_institutions(self):
+        query = self.get_institutions_query()
+        if query is None:
+            return 0
+        return query.count()
+
+    def get_institutions_page(self, after=None, page_size=default_matches_page_size):
+        # (institution dicts, last grid id on the page or None when there are no more), in grid id order.
+        # a country-wide agreement can cover thousands, so this pages on grid_id rather than loading them all
+        query = self.get_institutions_query()
+        if query is None:
+            return ([], None)
+        if after:
+            query = query.filter(Institution.grid_id > after)
+        institutions = query.options(orm.load_only("grid_id", "org_name")).order_by(Institution.grid_id).limit(page_size + 1).all()
+        next_after = institutions[page_size - 1].grid_id if len(institutions) > page_size else None
+        institution_dicts = [{"id": inst.grid_id, "name": inst.org_name} for inst in institutions[:page_size]]
+        return (institution_dicts, next_after)
+
+    @property
+    def covered_issnls(self):
+        # agreements are read-only here, so build the set once per object
+        if getattr(self, "_covered_issnls", None) is None:
+            self._covered_issnls = frozenset([match.issnl for match in self.issnl_matches] + [self.issnl])
+        return self._covered_issnls
+
+    def covers_institution(self, institution):
+        if (self.grid_id and self.grid_id != institution.grid_id):
             return False
         if self.country_code:
-            if self.country_code != to_this_institution.country_code:
+            if self.country_code != institution.country_code:
                 return False
-        if issnl not in [match.issnl for match in self.issnl_matches] + [self.issnl]:
+        return True
+
+    def applies(self, issnl, to_this_institution):
+        if not self.covers_institution(to_this_institution):
+            return False
+        if issnl not in self.covered_issnls:
             return False
         return True
 
-    def to_dict(self):
+    def to_dict(self, matches=None):
+        # pass matches from get_agreement_matches when rendering several agreements
+        if matches is None:
+            matches = get_agreement_matches([self])[self.id]
+
         between_publisher = None
         if self.issnl:
             between_publisher = {"type": "journal", "id": self.issnl}
@@ -91,10 +149,7 @@ class TransformativeAgreement(db.Model):
             "link": self.link,
             "esac_id": self.esac_id,
 
-            "matches": {
-                "journals": self.journals_list,
-                "institutions": self.institutions_list
-            },
+            "matches": matches,
 
             # j adding these to make it easier to print out something in the frontend
             "content_owner": self.publisher_or_journal,
@@ -105,16 +160,106 @@ class TransformativeAgreement(db.Model):
 
 
     def to_dict_short(self):
-        ret = self.to_dict()
-        del ret["matches"]["journals"]
-        del ret["matches"]["institutions"]
+        ret = self.to_dict(matches={})
         return ret
 
 
+def get_first_institution_pages(grid_ids, country_codes, page_size):
+    # (match type, grid id or country code) -> (first page of institution dicts, number matched),
+    # for all of them in one query
+    command = """
+        select match_type, match_key, grid_id, org_name, num_matches from (
+            select 'grid_id' as match_type, grid_id as match_key, grid_id, org_name,
+                1 as match_rank, 1 as num_matches
+            from bq_institutions
+            where grid_id = any(cast(:grid_ids as text[]))
+            union all
+            select 'country_code' as match_type, country_code as match_key, grid_id, org_name,
+                row_number() over (partition by country_code order by grid_id) as match_rank,
+                count(*) over (partition by country_code) as num_matches
+            from bq_institutions
+            where country_code = any(cast(:country_codes as text[]))
+        ) s
+        where match_rank <= :page_size
+        order by match_type, match_key, match_rank
+    """
+    rows = db.get_engine(app, bind="unpaywall_db").execute(sql.text(command),
+                                                           grid_ids=list(grid_ids),
+                                                           country_codes=list(country_codes),
+                                                           page_size=page_size)
+    pages = {}
+    for row in rows:
+        (institution_dicts, num_matches) = pages.setdefault((row["match_type"], row["match_key"]), ([], row["num_matches"]))
+        institution_dicts.append({"id": row["grid_id"], "name": row["org_name"]})
+    return pages
+
+def get_agreement_matches(agreements, page_size=default_matches_page_size):
+    # agreement id -> counts plus the first page of journals and of institutions, for any number
+    # of agreements with one institution query; journal names come from the journal catalog.
+    # the rest of each list is under /transformative-agreement/<id>/journals and /institutions
+    grid_ids = set(my_ta.grid_id for my_ta in agreements if my_ta.grid_id)
+    country_codes = set(my_ta.country_code for my_ta in agreements if my_ta.country_code and not my_ta.grid_id)
+    institution_pages = {}
+    if grid_ids or country_codes:
+        institution_pages = get_first_institution_pages(grid_ids, country_codes, page_size)
+
+    response = {}
+    for my_ta in agreements:
+        (journal_dicts, journals_after) = my_ta.get_journals_page(page_size=page_size)
 
+        if my_ta.grid_id:
+            (institution_dicts, num_institutions) = institution_pages.get(("grid_id", my_ta.grid_id), ([], 0))
+        elif my_ta.country_code:
+            (institution_dicts, num_institutions) = institution_pages.get(("country_code", my_ta.country_code), ([], 0))
+        else:
+            (institution_dicts, num_institutions) = ([], 0)
+        institutions_after = institution_dicts[-1]["id"] if num_institutions > page_size else None
+
+        response[my_ta.id] = {
+            "num_journals": my_ta.num_journals,
+            "num_institutions": num_institutions,
+            "journals": journal_dicts,
+            "institutions": institution_dicts,
+            "journals_next_cursor": encode_cursor([journals_after]) if journals_after else None,
+            "institutions_next_cursor": encode_cursor([institutions_after]) if institutions_after else None
+        }
+    return response
 
 
+class TransformativeAgreementIndex(object):
+    # agreements by the issnls they cover and by who they cover: a grid id, a country,
+    # or everyone when they name neither.  results keep the order of `agreements`.
+    def __init__(self, agreements):
+        self.agreements = agreements
+        self.by_issnl = defaultdict(list)
+        self.by_grid_id = defaultdict(list)
+        self.by_country_code = defaultdict(list)
+        self.unrestricted = []
+        for my_ta in agreements:
+            for issnl in my_ta.covered_issnls:
+                if issnl:
+                    self.by_issnl[issnl].append(my_ta)
+            if my_ta.grid_id:
+                self.by_grid_id[my_ta.grid_id].append(my_ta)
+            elif my_ta.country_code:
+                self.by_country_code[my_ta.country_code].append(my_ta)
+            else:
+                self.unrestricted.append(my_ta)
+        self.positions = dict((id(my_ta), i) for (i, my_ta) in enumerate(agreements))
 
+    def __iter__(self):
+        return iter(self.agreements)
 
+    def __len__(self):
+        return len(self.agreements)
 
+    def covering_institution(self, institution):
+        candidates = self.by_grid_id.get(institution.grid_id, []) \
+                     + self.by_country_code.get(institution.country_code, []) \
+                     + self.unrestricted
+        matches = [my_ta for my_ta in candidates if my_ta.covers_institution(institution)]
+        return sorted(matches, key=lambda my_ta: self.positions[id(my_ta)])
 
+    def applying(self, issnl, institution):
+        # the agreements that make this journal compliant for this institution
+        return [my_ta for my_ta in self.by_issnl.get(issnl, []) if my_ta.covers_institution(institution)]
@@ -13,12 +13,15 @@ import requests
 import heroku3
 import json
 import copy
+import base64
 from unidecode import unidecode
 from sqlalchemy import sql
 from sqlalchemy import exc
 from subprocess import call
 from requests.adapters import HTTPAdapter
+from io import BytesIO
 import csv
+import unicodecsv
 
 def str2bool(v):
     if not v:
@@ -692,7 +695,7 @@ def find_normalized_license(text):
     return None
 
 def myconverter(o):
-    if isinstance(o, datetime.datetime):
+    if isinstance(o, (datetime.datetime, datetime.date)):
         return o.isoformat()
     raise TypeError(repr(o) + " is not JSON serializable")
 
@@ -719,4 +722,42 @@ def jsonify_fast_no_sort(*args, **kwargs):
               indent=None,
               # separators=None,
               sort_keys=sort_keys) + u'\n', mimetype=current_app.config['JSONIFY_MIMETYPE']
-    )
\ No newline at end of file
+    )
+
+def csv_response(keys, rows, filename=None):
+    """
+    Streams a csv, encoding each row into the response as it is produced.
+
+    rows can be any iterable of lists in the same order as keys, including a generator.
+    """
+    def generate():
+        buffer = BytesIO()
+        writer = unicodecsv.writer(buffer, encoding='utf-8')
+        writer.writerow(keys)
+        yield buffer.getvalue()
+        for row in rows:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(row)
+            yield buffer.getvalue()
+
+    response = current_app.response_class(generate(), mimetype="text/csv")
+    if filename:
+        response.headers["Content-Disposition"] = u"attachment; filename={}".format(filename)
+    return response
+
+def encode_cursor(values):
+    # an opaque page cursor: the sort key of the last row on the page
+    return base64.urlsafe_b64encode(json.dumps(values, default=myconverter))
+
+def decode_cursor(cursor, num_values=1):
+    # raises ValueError when the cursor wasn't one of ours: a list of num_values strings
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError(u"invalid cursor")
+    if not isinstance(values, list) or len(values) != num_values:
+        raise ValueError(u"invalid cursor")
+    if not all(isinstance(value, basestring) for value in values):
+        raise ValueError(u"invalid cursor")
+    return values
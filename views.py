@@ -1,10 +1,8 @@
 from flask import make_response
 from flask import request
-from flask import redirect
 from flask import abort
 from flask import render_template
 from flask import jsonify
-from flask import g
 from flask import Response
 
 import json
@@ -13,18 +11,10 @@ import sys
 import re
 import datetime
 from time import time
-import boto
 import pickle
-from util import read_csv_file
 from util import elapsed
-from util import to_unicode_or_bust
-from collections import defaultdict
-from sqlalchemy import sql
 from sqlalchemy import orm
 import newrelic.agent
-import psycopg2
-import hashlib
-import unicodecsv as csv
 import dateutil.parser
 from monthdelta import monthdelta
 import requests
@@ -32,29 +22,50 @@ from collections import OrderedDict
 import copy
 
 from app import app
-from app import db
-from app import get_db_connection
 from app import get_db_cursor
 from app import logger
-from data.funders import funder_names
-from journal import Journal
-from topic import Topic
+from datasets import datasets_status
+from datasets import datasets_ready
+from datasets import dataset_families_status
+from datasets import start_warm_up_thread
+from datasets import start_refresh_thread
+from datasets import register_dataset
+from datasets import files_version
+from prefix_cache import prefix_cache_stats
+from text_search import autocomplete_score
+from funder import funder_registry
+from data.country_groups import country_groups
+from journal import search_journal_titles
+from journal import journal_title_index
+from journal import journal_compliance_index
+from journal import journal_catalog
+from topic import search_topics
+from topic import topic_index
+from topic import get_topic_journal_issnls
 from institution import Institution
-from geo import get_geo_rows
+from institution import institution_to_dict
+from institution import search_institution_names
+from institution import institution_name_index
 from geo import get_oa_from_redshift
 from geo import get_oa_from_redshift_fast
 from geo import get_all_rows_fast
+from geo import get_geo_all_columns
+from geo import get_oa_for_region
+from geo import default_since_year
+from maps import get_map_json
 from transformative_agreement import TransformativeAgreement
+from subscription import get_subscriptions
+from subscription import get_subscription_model
 from util import str2bool
-from util import normalize_title
 from util import clean_doi
 from util import is_doi
 from util import is_issn
-from util import get_sql_answer
 from util import jsonify_fast
 from util import find_normalized_license
-from util import str2bool
 from util import jsonify_fast_no_sort
+from util import csv_response
+from util import encode_cursor
+from util import decode_cursor
 from util import NotJournalArticleException
 from util import NoDoiException
 
@@ -126,87 +137,175 @@ def base_endpoint():
     })
 
 
-@app.route("/autocomplete/topics/name/<q>", methods=["GET"])
-def topics_title_search(q):
+@app.route('/ready', methods=["GET"])
+def ready_endpoint():
+    ready = datasets_ready()
+    resp = jsonify_fast({
+        "ready": ready,
+        "datasets": datasets_status(),
+        "dataset_families": dataset_families_status(),
+        "autocomplete_caches": prefix_cache_stats()
+    })
+    if not ready:
+        resp.status_code = 503
+    return resp
+
+
+def autocomplete_topics(q, limit=10):
     ret = []
+    for (topic, num_total_3years, rank) in search_topics(q, limit=limit):
+        ret.append({
+            "topic": topic,
+            "num_total_3years": num_total_3years,
+            "fulltext_rank": rank,
+            "score": float(num_total_3years or 0) + 100000 * rank,
+        })
+    return ret
 
-    query_for_search = re.sub(r'[!\'()|&]', ' ', q).strip()
-    if query_for_search:
-        query_for_search = re.sub(r'\s+', ' & ', query_for_search)
-        query_for_search += ':*'
-
-    command = """with together as (
-			select
-            topic,
-            sum(num_articles_3years) as num_total_3years
-        	from bq_scimago_issnl_topics group by topic)
-            select 
-                topic,
-                num_total_3years, 
-                ts_rank_cd(to_tsvector('only_stop_words', topic), query, 1) AS rank,
-                num_total_3years + 100000 * ts_rank_cd(to_tsvector('only_stop_words', topic), query, 1) as score
-            from together, to_tsquery('only_stop_words', '{query_for_search}') query
-            where to_tsvector('only_stop_words', topic) @@ query
-            order by num_total_3years + 100000 * ts_rank_cd(to_tsvector('only_stop_words', topic), query, 1) desc
-            limit 10
-        """.format(query_for_search=query_for_search)
-    res = db.session.connection().execute(sql.text(command))
-    rows = res.fetchall()
-    for row in rows:
+def autocomplete_journals(q, limit=10):
+    ret = []
+    for (journal, rank) in search_journal_titles(q, limit=limit):
         ret.append({
-            "topic": row[0],
-            "num_total_3years": row[1],
-            "fulltext_rank": row[2],
-            "score": row[3],
+            "id": journal.issnl,
+            "num_articles_since_2018": journal.num_articles_since_2018,
+            "name": journal.title,
+            "prop_cc_by_since_2018": journal.prop_cc_by_since_2018,
+            "fulltext_rank": rank,
+            "score": float(journal.num_articles_since_2018 or 0) + 10000 * rank,
         })
+    return ret
+
+def autocomplete_institutions(q, limit=10):
+    return [institution_to_dict(inst) for inst in search_institution_names(q, limit=limit)]
+
+def autocomplete_funders(q, limit=None):
+    ret = funder_registry.search(q)
+    if limit:
+        ret = ret[:limit]
+    return ret
+
+autocomplete_types = OrderedDict([
+    ("journals", autocomplete_journals),
+    ("topics", autocomplete_topics),
+    ("institutions", autocomplete_institutions),
+    ("funders", autocomplete_funders),
+])
+
+# for the merged /autocomplete list: entity type -> (the names q matched against and the
+# popularity of an entry, the biggest popularity of that type)
+autocomplete_scoring = {
+    "journals": (lambda entry: ([entry["name"]], entry["num_articles_since_2018"]),
+                 lambda: journal_title_index.get().max_num_articles_since_2018),
+    "topics": (lambda entry: ([entry["topic"]], entry["num_total_3years"]),
+               lambda: topic_index.get().max_num_total_3years),
+    "institutions": (lambda entry: ([entry["name"]], entry["num_papers"]),
+                     lambda: institution_name_index.get().max_num_papers),
+    "funders": (lambda entry: ([entry["name"]] + (entry["alternate_names"] or u"").split(u"|"), entry.get("works_count")),
+                lambda: funder_registry.max_works_count),
+}
+
+@app.route("/autocomplete", methods=["GET"])
+def autocomplete_all():
+    # every entity type in one request: ?q=<text>, plus journals=, topics=, institutions=
+    # and funders= to change how many of each come back (default 10, 0 to leave a type out).
+    # "list" has them all ranked together by normalized_score, each tagged with its entity_type;
+    # the same entries are grouped by type under the type names too
+    q = request.args.get("q", u"")
+    response = {}
+    merged = []
+    for (entity_type, autocomplete_function) in autocomplete_types.iteritems():
+        try:
+            limit = int(request.args.get(entity_type, 10))
+        except ValueError:
+            abort_json(400, u"{} should be a number of results".format(entity_type))
+        if limit <= 0:
+            continue
+        ret = autocomplete_function(q, limit=limit) if q.strip() else []
+        (get_names_and_popularity, get_max_popularity) = autocomplete_scoring[entity_type]
+        max_popularity = get_max_popularity() if ret else None
+        entries = []
+        for entry in ret:
+            (names, popularity) = get_names_and_popularity(entry)
+            # copies, funder entries are the registry's own dicts
+            entries.append(dict(entry,
+                                entity_type=entity_type,
+                                normalized_score=autocomplete_score(q, names, popularity, max_popularity)))
+        response[entity_type] = {"list": entries, "count": len(entries)}
+        merged += entries
+    response["list"] = sorted(merged, key=lambda entry: entry["normalized_score"], reverse=True)
+    response["count"] = len(merged)
+    return jsonify(response)
+
+@app.route("/autocomplete/topics/name/<q>", methods=["GET"])
+def topics_title_search(q):
+    ret = autocomplete_topics(q)
     return jsonify({ "list": ret, "count": len(ret)})
 
 @app.route("/autocomplete/journals/name/<q>", methods=["GET"])
 def journal_title_search(q):
-    ret = []
-
-    query_for_search = re.sub(r'[!\'()|&]', ' ', q).strip()
-    if query_for_search:
-        query_for_search = re.sub(r'\s+', ' & ', query_for_search)
-        query_for_search += ':*'
-
-    command = """select 
-                issnl, 
-                num_articles_since_2018, 
-                title, 
-                prop_cc_by_since_2018,
-                ts_rank_cd(to_tsvector('only_stop_words', title), query, 1) AS rank,
-                num_articles_since_2018 + 10000 * ts_rank_cd(to_tsvector('only_stop_words', title), query, 1) as score
-            
-            from bq_our_journals_issnl, to_tsquery('only_stop_words', '{query_for_search}') query
-            where to_tsvector('only_stop_words', title) @@ query
-            order by num_articles_since_2018 + 10000 * ts_rank_cd(to_tsvector('only_stop_words', title), query, 1) desc
-            limit 10
-    """.format(query_for_search=query_for_search)
-    res = db.session.connection().execute(sql.text(command))
-    rows = res.fetchall()
-    for row in rows:
-        ret.append({
-            "id": row[0],
-            "num_articles_since_2018": row[1],
-            "name": row[2],
-            "prop_cc_by_since_2018": row[3],
-            "fulltext_rank": row[4],
-            "score": row[5],
-        })
+    ret = autocomplete_journals(q)
     return jsonify({ "list": ret, "count": len(ret)})
 
 
 @app.route("/transformative-agreements", methods=["GET"])
 def transformative_agreements_get():
-    transformative_agreements = TransformativeAgreement.query.all()
+    # the short form leaves out the matches, so don't load them
+    transformative_agreements = TransformativeAgreement.query.options(orm.noload(TransformativeAgreement.issnl_matches)).all()
     return jsonify({"list": [ta.to_dict_short() for ta in transformative_agreements], "count": len(transformative_agreements)})
 
+def get_transformative_agreement_or_abort(id):
+    my_ta = TransformativeAgreement.query.get(id)
+    if not my_ta:
+        abort_json(404, u"no transformative agreement found with id {}".format(id))
+    return my_ta
+
+def get_cursor_page_args(default_page_size=100, max_page_size=1000):
+    # (decoded cursor or None, page size) from ?cursor= and ?page_size=
+    try:
+        page_size = min(int(request.args.get("page_size", default_page_size)), max_page_size)
+    except ValueError:
+        abort_json(400, u"page_size should be a number")
+    if page_size < 1:
+        abort_json(400, u"page_size should be at least 1")
+    cursor = request.args.get("cursor", None)
+    if not cursor:
+        return (None, page_size)
+    try:
+        return (decode_cursor(cursor), page_size)
+    except ValueError as e:
+        abort_json(400, unicode(e))
+
 @app.route("/transformative-agreement/<id>", methods=["GET"])
 def transformative_agreement_lookup(id):
-    my_ta = TransformativeAgreement.query.get(id)
+    my_ta = get_transformative_agreement_or_abort(id)
     return jsonify(my_ta.to_dict())
 
+@app.route("/transformative-agreement/<id>/journals", methods=["GET"])
+def transformative_agreement_journals(id):
+    my_ta = get_transformative_agreement_or_abort(id)
+    (cursor, page_size) = get_cursor_page_args()
+    after = cursor[0] if cursor else None
+    (ret, next_after) = my_ta.get_journals_page(after, page_size)
+    return jsonify({
+        "list": ret,
+        "count": len(ret),
+        "total_count": my_ta.num_journals,
+        "next_cursor": encode_cursor([next_after]) if next_after else None
+    })
+
+@app.route("/transformative-agreement/<id>/institutions", methods=["GET"])
+def transformative_agreement_institutions(id):
+    my_ta = get_transformative_agreement_or_abort(id)
+    (cursor, page_size) = get_cursor_page_args()
+    after = cursor[0] if cursor else None
+    (ret, next_after) = my_ta.get_institutions_page(after, page_size)
+    return jsonify({
+        "list": ret,
+        "count": len(ret),
+        "total_count": my_ta.num_institutions,
+        "next_cursor": encode_cursor([next_after]) if next_after else None
+    })
+
 
 @app.route("/institution/<id>", methods=["GET"])
 def institution_lookup(id):
@@ -217,24 +316,24 @@ def institution_lookup(id):
 @app.route("/funder/<id>", methods=["GET"])
 def funder_lookup(id):
 
-    matches = [funder for funder in funder_names if str(funder["id"]) == str(id)]
+    funder = funder_registry.get(id)
     name = None
-    if matches:
-        name = matches[0]["name"]
+    if funder:
+        name = funder["name"]
 
     return jsonify({"id": id, "name": name})
 
 
 @app.route("/autocomplete/institutions/name/<q>", methods=["GET"])
 def institutions_name_autocomplete(q):
-    institutions = Institution.query.filter(Institution.org_name.ilike(u'%{}%'.format(q))).order_by(Institution.num_papers.desc()).limit(10).all()
-    return jsonify({"list": [inst.to_dict() for inst in institutions], "count": len(institutions)})
+    ret = autocomplete_institutions(q)
+    return jsonify({"list": ret, "count": len(ret)})
 
 
 @app.route("/autocomplete/funders/name/<q>", methods=["GET"])
 def funders_name_search(q):
 
-    ret = [funder for funder in funder_names if q.lower() in funder["alternate_names"].lower()]
+    ret = autocomplete_funders(q)
 
     return jsonify({"list": ret, "count": len(ret)})
 
@@ -248,7 +347,9 @@ def journal_issnl_get(issnl_query):
     else:
         institution = None
 
-    my_journal = Journal.query.filter(Journal.issnl == issnl_query).first()
+    my_journal = journal_catalog.get().get(issnl_query)
+    if not my_journal:
+        abort_json(404, u"no journal found with issnl {}".format(issnl_query))
     return jsonify(my_journal.to_dict_full(funder_id, institution))
 
 
@@ -272,13 +373,16 @@ def topic_get(topic_query):
     else:
         limit = 1000
 
-    topic_hits = Topic.query.filter(Topic.topic == topic_query).order_by(Topic.num_articles_3years.desc()).limit(limit)
-    our_journals = Journal.query.filter(Journal.issnl.in_([t.issnl for t in topic_hits])).all()
-    responses = []
-    for this_journal in our_journals:
-        if include_uncompliant or this_journal.is_compliant(funder_id, institution):
-            response = this_journal.to_dict_journal_row(funder_id, institution)
-            responses.append(response)
+    issnls = get_topic_journal_issnls(topic_query, limit)
+
+    # filter and pick the 50 before loading any journals
+    compliance_index = journal_compliance_index.get()
+    if not include_uncompliant:
+        issnls = compliance_index.filter_compliant(issnls, funder_id, institution)
+    issnls = compliance_index.most_recent_articles(issnls, 50)
+
+    our_journals = journal_catalog.get().get_many(issnls)
+    responses = [this_journal.to_dict_journal_row(funder_id, institution) for this_journal in our_journals]
     responses = sorted(responses, key=lambda k: k['num_articles_since_2018'], reverse=True)[:50]
     return jsonify({ "list": responses, "count": len(responses)})
 
@@ -304,111 +408,40 @@ def search_journals_get(journal_query):
     else:
         limit = 1000
 
-    response = []
-
-    query_for_search = re.sub(r'[!\'()|&]', ' ', journal_query).strip()
-    if query_for_search:
-        query_for_search = re.sub(r'\s+', ' & ', query_for_search)
-        query_for_search += ':*'
-
-    command = """select 
-                issnl, 
-                ts_rank_cd(to_tsvector('only_stop_words', title), query, 1) AS rank,
-                num_articles + 10000 * ts_rank_cd(to_tsvector('only_stop_words', title), query, 1) as score
-            from bq_our_journals_issnl, to_tsquery('only_stop_words', '{query_for_search}') query
-            where to_tsvector('only_stop_words', title) @@ query
-            order by num_articles_since_2018 + 10000 * ts_rank_cd(to_tsvector('only_stop_words', title), query, 1) desc
-            limit {limit}
-    """.format(query_for_search=query_for_search, limit=limit)
-    res = db.session.connection().execute(sql.text(command))
-    rows = res.fetchall()
-
-    issnls = [row[0] for row in rows]
-    our_journals = Journal.query.filter(Journal.issnl.in_(issnls)).all()
-    # print our_journals
+    # (issnl, rank, score)
+    rows = [(journal.issnl, rank, float(journal.num_articles or 0) + 10000 * rank)
+            for (journal, rank) in search_journal_titles(journal_query, limit=limit)]
+
+    # filter and pick the 50 before loading any journals
+    if not include_uncompliant:
+        compliant_issnls = set(journal_compliance_index.get().filter_compliant([row[0] for row in rows], funder_id, institution))
+        rows = [row for row in rows if row[0] in compliant_issnls]
+    rows = sorted(rows, key=lambda row: row[2], reverse=True)[:50]
+    rows_by_issnl = dict((row[0], row) for row in rows)
+
+    our_journals = journal_catalog.get().get_many(rows_by_issnl.keys())
     responses = []
     for this_journal in our_journals:
-        if include_uncompliant or this_journal.is_compliant(funder_id, institution):
-            response = this_journal.to_dict_journal_row(funder_id, institution)
-            matching_score_row = [row for row in rows if row[0]==this_journal.issnl][0]
-            response["fulltext_rank"] = matching_score_row[1]
-            response["score"] = matching_score_row[2]
-            responses.append(response)
+        response = this_journal.to_dict_journal_row(funder_id, institution)
+        response["fulltext_rank"] = rows_by_issnl[this_journal.issnl][1]
+        response["score"] = rows_by_issnl[this_journal.issnl][2]
+        responses.append(response)
 
     responses = sorted(responses, key=lambda k: k['score'], reverse=True)[:50]
 
     return jsonify({ "list": responses, "count": len(responses)})
 
 
-def get_subscription_rows(package="cdl_elsevier"):
-
-    command = "select * from ricks_unpaywall_journals_subscription_agg where package_id = %s"
-
-    with get_db_cursor() as cursor:
-        cursor.execute(command, (package,))
-        rows = cursor.fetchall()
-    return rows
-
-def display_closed_access_downloads(row):
-    if not row["num_papers"] or not ["num_is_oa"] or not row["mit_counter_age_0y"]:
-        return None
-
-    percent_closed = 1 - float(row["num_is_oa"])/row["num_papers"]
-    num_downloads = float(row["mit_counter_age_0y"])
-    closed_access_downloads = percent_closed * num_downloads
-    if closed_access_downloads > 190:
-        return "high"
-    if closed_access_downloads > 50:
-        return "medium"
-    return "low"
-
-def display_downloads(row):
-    num_downloads = row["mit_counter_age_0y"]
-    if num_downloads > 250:
-        return "high"
-    if num_downloads > 67:
-        return "medium"
-    return "low"
-
-def get_subscriptions(package):
-    responses = []
-    rows = get_subscription_rows(package)
-
-
-    for row in rows:
-        my_dict = {
-            "issnl": row["journal_issn_l"],
-            "journal_issn_l": row["journal_issn_l"],
-            "journal_name": row["title"],
-            # "publisher": row["publisher"],
-            "affected_start_date": row["from_date"],
-            "affected_end_date": row["to_date"],
-            "num_dois": row["num_papers"],
-            "num_oa": row["num_is_oa"],
-            "proportion_publisher_hosted": round(float(row["num_publisher_hosted"]) / row["num_papers"], 4),
-            "proportion_repository_hosted": round(float(row["num_repository_hosted"]) / row["num_papers"], 4),
-            "proportion_oa": round(float(row["num_is_oa"]) / row["num_papers"], 4),
-            "issns": json.loads(row["issns"]),
-            "score": row["num_papers"]
-        }
-        if my_dict["affected_start_date"]:
-            if my_dict["affected_start_date"].isoformat()[0:10].endswith('12-31'):
-                my_dict["affected_start_date"] = my_dict["affected_start_date"] + datetime.timedelta(days=1)
-            my_dict["affected_start_date"] = my_dict["affected_start_date"].isoformat()[0:10]
-        if my_dict["affected_end_date"]:
-            my_dict["affected_end_date"] = my_dict["affected_end_date"].isoformat()[0:10]
-        if package == "mit_elsevier":
-            my_dict.update({
-            "closed_access_downloads": display_closed_access_downloads(row),
-            "downloads": display_downloads(row),
-            "num_citations": row["mit_num_citations"] if row["mit_num_citations"] else 0,
-            })
-
-        responses.append(my_dict)
-
-    responses = sorted(responses, key=lambda k: k['score'], reverse=True)
-    return responses
-
+def get_requested_columns(all_keys, default_keys=None):
+    # ?columns=a,b,c picks and orders the columns of a tabular response
+    columns_arg = request.args.get("columns", None)
+    if not columns_arg:
+        return default_keys or all_keys
+    columns = [column.strip() for column in columns_arg.split(",") if column.strip()]
+    unknown_columns = [column for column in columns if column not in all_keys]
+    if unknown_columns:
+        abort_json(400, u"unknown columns {}, try some of: {}".format(u", ".join(unknown_columns), u", ".join(all_keys)))
+    return columns
 
 @app.route("/subscriptions.csv", methods=["GET"])
 def unpaywall_journals_subscriptions_csv():
@@ -424,20 +457,11 @@ def unpaywall_journals_subscriptions_csv():
         return subscription[key]
 
     subscriptions = get_subscriptions(package)
+    all_keys = [k for k in sorted(subscriptions[0].keys()) if k != 'score'] if subscriptions else []
+    keys = get_requested_columns(all_keys)
 
-    filename = "subscriptions.csv"
-    with open(filename, "w") as file:
-        csv_file = csv.writer(file, encoding='utf-8')
-        keys = [k for k in sorted(subscriptions[0].keys()) if k != 'score']
-        csv_file.writerow(keys)
-        for subscription in subscriptions:
-            csv_file.writerow([csv_value(subscription, k) for k in keys])
-
-    with open(filename, "r") as file:
-        contents = file.readlines()
-
-    # return Response(contents, mimetype="text/text")
-    return Response(contents, mimetype="text/csv")
+    rows = ([csv_value(subscription, k) for k in keys] for subscription in subscriptions)
+    return csv_response(keys, rows)
 
 
 @app.route("/subscriptions", methods=["GET"])
@@ -449,37 +473,31 @@ def unpaywall_journals_subscriptions_get():
 @app.route("/subscriptions/name/<q>", methods=["GET"])
 def unpaywall_journals_autocomplete_journals(q):
     package = request.args.get("package", "cdl_elsevier")
-    responses = get_subscriptions(package)
-    filtered_responses = []
-    for response in responses:
-        if to_unicode_or_bust(q).lower() in to_unicode_or_bust(response["journal_name"]).lower():
-            filtered_responses.append(response)
+    filtered_responses = get_subscription_model(package).search_titles(q)
     return jsonify({ "list": filtered_responses, "count": len(filtered_responses)})
 
 @app.route("/subscription/issn/<q>", methods=["GET"])
 def unpaywall_journals_issn(q):
     package = request.args.get("package", "cdl_elsevier")
-    responses = get_subscriptions(package)
-    for response in responses:
-        if to_unicode_or_bust(q).lower() in response["issns"]:
-            return jsonify(response)
+    response = get_subscription_model(package).get_by_issn(q)
+    if response:
+        return jsonify(response)
     abort_json(404, u"issn not found in this subscription package")
 
 
 @app.route("/breakdown", methods=["GET"])
 def unpaywall_journals_breakdown():
     package = request.args.get("package", "cdl_elsevier")
-    rows = get_subscription_rows(package)
-    response = {
-        "article_breakdown": {
-            "num_closed": sum([r["num_papers"] - r["num_is_oa"] for r in rows]),
-            "num_has_repository_hosted_and_has_publisher_hosted": sum([r["num_has_repository_hosted_and_has_publisher_hosted"] for r in rows]),
-            "num_has_repository_hosted_and_not_publisher_hosted": sum([r["num_has_repository_hosted_and_not_publisher_hosted"] for r in rows]),
-            "num_not_repository_hosted_and_has_publisher_hosted": sum([r["num_not_repository_hosted_and_has_publisher_hosted"] for r in rows])
-        },
-        "num_articles_total": sum([r["num_papers"] for r in rows]),
-        "num_journals_total": len(rows),
-    }
+    model = get_subscription_model(package)
+    response = dict(model.breakdown)
+
+    breakdown_by = request.args.get("by", None)
+    if breakdown_by == "year":
+        response["by_year"] = model.get_year_breakdown()
+    elif breakdown_by == "oa_host":
+        response["by_oa_host"] = model.oa_host_breakdown
+    elif breakdown_by:
+        abort_json(400, u"unknown breakdown {}, try one of: year, oa_host".format(breakdown_by))
     return jsonify(response)
 
 def build_oa_filter():
@@ -504,10 +522,33 @@ def build_text_filter():
     return text_filter
 
 
-def get_total_count(package):
-
-    command = """
-            select count(doi) as num_articles
+def get_planner_count(command):
+    # the row estimate from the top of the query plan, instead of running the count
+    with get_db_cursor(cursor_factory=None) as cursor:
+        cursor.execute(u"explain " + command)
+        plan = cursor.fetchall()
+    match = re.search(r"rows=(\d+)", plan[0][0]) if plan else None
+    return int(match.group(1)) if match else None
+
+def get_total_count(package, exact=False):
+    # (count, is_exact).  exact counts are kept on the package model per filter, so paging
+    # through the same filters pays for the count once.  without exact, an uncached count
+    # comes from the package totals when nothing filters by text, or from the query planner.
+    model = get_subscription_model(package)
+    text_filter = build_text_filter()
+    oa_filter = build_oa_filter()
+    filters = (text_filter, oa_filter)
+
+    count = model.get_article_count(filters)
+    if count is not None:
+        return (count, True)
+
+    if not exact and not text_filter:
+        if oa_filter:
+            return (model.totals["num_is_oa"], False)
+        return (model.totals["num_papers"], False)
+
+    articles_query = u"""
             from unpaywall_production u
             join ricks_unpaywall_journals_subscription_agg j on u.journal_issn_l = j.journal_issn_l
             where 
@@ -515,17 +556,33 @@ def get_total_count(package):
             u.published_date >= coalesce(j.from_date, '1900-01-01'::timestamp) and u.published_date < coalesce(j.to_date, '2100-01-01'::timestamp)
             {text_filter}
             {oa_filter}
-        """.format(text_filter=build_text_filter(),
+        """.format(text_filter=text_filter,
                    package=package,
-                   oa_filter=build_oa_filter())
+                   oa_filter=oa_filter)
 
+    if not exact:
+        # explaining the count itself would only estimate its one row
+        count = get_planner_count(u"select doi " + articles_query)
+        if count is not None:
+            return (count, False)
+
+    command = u"select count(doi) as num_articles " + articles_query
     # print command
     with get_db_cursor() as cursor:
         cursor.execute(command)
         rows = cursor.fetchone()  # just get first row
 
-    return rows["num_articles"]
+    model.set_article_count(filters, rows["num_articles"])
+    return (rows["num_articles"], True)
+
+
+article_csv_keys = ["doi", "title", "journal_name", "journal_issn_l", "publisher", "published_date", "year", "genre", "is_oa", "oa_status"]
 
+def article_csv_value(value):
+    # nested parts of the api json go in as json
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
 
 @app.route("/articles", methods=["GET"])
 def unpaywall_journals_articles_paged():
@@ -545,54 +602,100 @@ def unpaywall_journals_articles_paged():
     if pagesize > 1000:
         abort_json(400, u"pagesize too large; max 1000")
 
-    offset = (page - 1) * pagesize
+    # ?cursor= pages by keyset on (published_date, doi), so a deep page costs what the first does.
+    # ?page= still works, with an offset, and every page hands back a cursor for the next one.
+    cursor_arg = request.args.get("cursor", None)
+    after = None
+    if cursor_arg:
+        try:
+            after = decode_cursor(cursor_arg, num_values=2)
+        except ValueError as e:
+            abort_json(400, unicode(e))
+        page = None
+        offset = 0
+    else:
+        offset = (page - 1) * pagesize
 
-    command = """
-        select usimple.doi, api_json 
-        from unpaywall_simple_sortkey usimple, 
-        (   select doi
-            from unpaywall_production u
-            join ricks_unpaywall_journals_subscription_agg j on u.journal_issn_l = j.journal_issn_l
-            where 
-                package_id = '{package}' and
-                u.published_date >= coalesce(j.from_date, '1900-01-01'::timestamp) and u.published_date < coalesce(j.to_date, '2100-01-01'::timestamp) 
-                {text_filter}
-                {oa_filter}
-            order by published_date desc
-            limit {pagesize}
-            offset {offset}) as s
-        where usimple.doi=s.doi    
-    """.format(pagesize=pagesize,
+    with get_db_cursor() as cursor:
+        keyset_filter = ""
+        if after:
+            keyset_filter = cursor.mogrify(
+                u" and (u.published_date < %s::timestamp or (u.published_date = %s::timestamp and u.doi < %s)) ",
+                (after[0], after[0], after[1])
+            ).decode("utf-8")
+
+        command = u"""
+            select s.doi, s.published_date, usimple.api_json
+            from
+            (   select doi, published_date
+                from unpaywall_production u
+                join ricks_unpaywall_journals_subscription_agg j on u.journal_issn_l = j.journal_issn_l
+                where
+                    package_id = '{package}' and
+                    u.published_date >= coalesce(j.from_date, '1900-01-01'::timestamp) and u.published_date < coalesce(j.to_date, '2100-01-01'::timestamp)
+                    {text_filter}
+                    {oa_filter}
+                    {keyset_filter}
+                order by published_date desc, doi desc
+                limit {pagesize}
+                offset {offset}) as s
+            left join unpaywall_simple_sortkey usimple on usimple.doi=s.doi
+            order by s.published_date desc, s.doi desc
+        """.format(pagesize=pagesize,
                    offset=offset,
                    package=package,
                    text_filter=build_text_filter(),
-                   oa_filter=build_oa_filter())
-    # print command
-    with get_db_cursor() as cursor:
+                   oa_filter=build_oa_filter(),
+                   keyset_filter=keyset_filter)
+        # print command
         cursor.execute(command)
         rows = cursor.fetchall()
-    responses = [json.loads(row["api_json"]) for row in rows]
+    # the page is cut before the join, so the next cursor holds even when a doi has no api_json
+    responses = [json.loads(row["api_json"]) for row in rows if row["api_json"]]
+
+    if request.args.get("format", None) == "csv":
+        all_keys = sorted(set(key for response in responses for key in response.keys()))
+        keys = get_requested_columns(all_keys, default_keys=[key for key in article_csv_keys if key in all_keys])
+        csv_rows = ([article_csv_value(response.get(key, None)) for key in keys] for response in responses)
+        return csv_response(keys, csv_rows, filename=u"articles_{}.csv".format(package))
+
+    next_cursor = None
+    if len(rows) == pagesize:
+        next_cursor = encode_cursor([rows[-1]["published_date"], rows[-1]["doi"]])
+
+    exact_count = str2bool(request.args.get("exact_count", "false"))
+    (total_count, is_exact) = get_total_count(package, exact=exact_count)
+
+    return jsonify({"page": page, "list": responses, "total_count": total_count, "total_count_is_exact": is_exact, "next_cursor": next_cursor})
 
-    return jsonify({"page": page, "list": responses, "total_count": get_total_count(package)})
 
 
 
+def get_since_year():
+    # ?since= for the geo endpoints, checked here so the geo code only ever sees a year
+    since = request.args.get("since", None)
+    if not since:
+        return default_since_year
+    try:
+        return int(since)
+    except ValueError:
+        abort_json(400, u"since should be a year, like {}".format(default_since_year))
 
 @newrelic.agent.function_trace()
 def get_oa_from_redshift_country():
-    return get_oa_from_redshift("country")
+    return get_oa_from_redshift("country", get_since_year())
 
 @newrelic.agent.function_trace()
 def get_oa_from_redshift_subcontinent():
-    return get_oa_from_redshift("subcontinent")
+    return get_oa_from_redshift("subcontinent", get_since_year())
 
 @newrelic.agent.function_trace()
 def get_oa_from_redshift_continent():
-    return get_oa_from_redshift("continent")
+    return get_oa_from_redshift("continent", get_since_year())
 
 @newrelic.agent.function_trace()
 def get_oa_from_redshift_global():
-    return get_oa_from_redshift("global")
+    return get_oa_from_redshift("global", get_since_year())
 
 
 @app.route("/metrics/geo", methods=["GET"])
@@ -602,9 +705,10 @@ def metrics_oa_geo_hack_for_subcontinents():
     groupby = request.args.get("groupby", "country")
     if groupby == "country":
         groupby = "subcontinent_as_country"
+    since_year = get_since_year()
     get_oa_newrelic_wrapper = newrelic.agent.FunctionTraceWrapper(
         get_oa_from_redshift_fast, name=groupby, group='get_oa_from_redshift')
-    (response, timing) = get_oa_newrelic_wrapper(groupby)
+    (response, timing) = get_oa_newrelic_wrapper(groupby, since_year)
     return jsonify_fast({"_timing": timing, "response": response})
 
 @app.route("/metrics/geo_real", methods=["GET"])
@@ -612,54 +716,62 @@ def metrics_oa_geo_hack_for_subcontinents():
 def metrics_oa_geo_fast():
 
     groupby = request.args.get("groupby", "country")
+    since_year = get_since_year()
     get_oa_newrelic_wrapper = newrelic.agent.FunctionTraceWrapper(
         get_oa_from_redshift_fast, name=groupby, group='get_oa_from_redshift')
-    (response, timing) = get_oa_newrelic_wrapper(groupby)
+    (response, timing) = get_oa_newrelic_wrapper(groupby, since_year)
+    return jsonify_fast({"_timing": timing, "response": response})
+
+@app.route("/metrics/geo/region", methods=["GET"])
+@newrelic.agent.function_trace()
+def metrics_oa_geo_region():
+    country_codes = [c.strip() for c in request.args.get("countries", "").split(",") if c.strip()]
+    region_name = request.args.get("name", None)
+
+    group = request.args.get("group", None)
+    if group:
+        if group.lower() not in country_groups:
+            abort_json(400, u"unknown group {}, try one of: {}".format(group, u", ".join(sorted(country_groups.keys()))))
+        country_codes = country_groups[group.lower()]["countries"] + country_codes
+        region_name = region_name or country_groups[group.lower()]["name"]
+
+    if not country_codes:
+        abort_json(400, u"specify countries=<comma separated iso2 or iso3 codes> and/or group=<group name>")
+    since_year = get_since_year()
+
+    try:
+        (response, timing) = get_oa_for_region(country_codes, region_name, since_year)
+    except ValueError as e:
+        abort_json(400, unicode(e))
     return jsonify_fast({"_timing": timing, "response": response})
 
 @app.route("/metrics/geo_all", methods=["GET"])
 @newrelic.agent.function_trace()
 def metrics_oa_geo_all_as_csv():
-
-    all_response_values = []
-    for level in ["country", "subcontinent", "continent", "global"]:
-
-        undefer_column = '*'
-        (rows, timing) = get_all_rows_fast(level, undefer_column)
-        for row in rows:
-            if row.get(level, "global"):
-                row["bronze_gold_green_hybrid"] = row["is_oa"]
-                row["gold_green_hybrid"] = row["green_gold_hybrid"]
-                del(row["green_gold_hybrid"])
-                row["bronze_gold_green"] = row["bronze_green_gold"]
-                del(row["bronze_green_gold"])
-                row["closed"] = row["num_distinct_articles"] - row["is_oa"]
-                row["year"] = int(row["year"])
-                row["continent"] = row.get("continent", None)
-                row["subcontinent"] = row.get("subcontinent", None)
-                row["name"] = row.get(level, "global")
-                row["iso2"] = row.get("country_iso2", None)
-                row["id"] = row.get("country_iso3", hashlib.md5(row["name"].encode()).hexdigest()[0:4])
-                row["level"] = level
-                all_response_values.append(row)
-
-    keys = rows[0].keys()
-    keys.reverse()  # a bit nicer this way
-    values = [[r[k] for k in keys] for r in all_response_values]  # do it this way to make sure they are in order
+    (keys, values, timing) = get_geo_all_columns()
+    if request.args.get("format", None) == "csv":
+        columns = get_requested_columns(keys)
+        column_indexes = [keys.index(column) for column in columns]
+        rows = ([row[i] for i in column_indexes] for row in values)
+        return csv_response(columns, rows, filename="geo_all.csv")
     return jsonify_fast({"_timing": timing, "response": {"keys": keys, "values": values}})
 
 @app.route("/metrics/map/continent", methods=["GET"])
 @newrelic.agent.function_trace()
 def metrics_continent_map():
-    with open("data/world-continents.json") as f:
-        data = f.read()
+    try:
+        data = get_map_json("continent", request.args.get("resolution", None))
+    except ValueError as e:
+        abort_json(400, unicode(e))
     return Response(data, mimetype="application/json")
 
 @app.route("/metrics/map/country", methods=["GET"])
 @newrelic.agent.function_trace()
 def metrics_country_map():
-    with open("data/world-countries-sans-antarctica.json") as f:
-        data = f.read()
+    try:
+        data = get_map_json("country", request.args.get("resolution", None))
+    except ValueError as e:
+        abort_json(400, unicode(e))
     return Response(data, mimetype="application/json")
 
 @app.route("/metrics/iso2_to_iso3", methods=["GET"])
@@ -1356,7 +1468,7 @@ def jump_issn_get(issn_l):
     min_arg = request.args.get("min", None)
 
     if use_cache:
-        jump_response = jump_cache[package]
+        jump_response = jump_cache.get()[package]
     else:
         jump_response = get_jump_response(package, min_arg)
 
@@ -1399,8 +1511,7 @@ def jump_get():
     min_arg = request.args.get("min", None)
 
     if use_cache:
-        global jump_cache
-        return jsonify_fast(jump_cache[package])
+        return jsonify_fast(jump_cache.get()[package])
     else:
         return jsonify_fast(get_jump_response(package, min_arg))
 
@@ -1555,21 +1666,29 @@ def get_jump_response(package="mit_elsevier", min_arg=None):
 
     timing_messages = ["{}: {}s".format(*item) for item in timing]
     return {"_timing": timing_messages, "list": sorted_rows, "total": summary_dict, "count": len(sorted_rows)}
-#
-# jump_cache = {}
-# store_cache = False
-# if store_cache:
-#     print "building cache"
-#     for package in ["cdl_elsevier", "mit_elsevier", "uva_elsevier"]:
-#         print package
-#         jump_cache[package] = get_jump_response(package)
-#         pickle.dump(jump_cache, open( "data/jump_cache.pkl", "wb" ), -1)
-#     print "done"
-# else:
-#     print "loading cache"
-#     jump_cache = pickle.load(open( "data/jump_cache.pkl", "rb" ))
 
 
+jump_cache_filename = "data/jump_cache.pkl"
+
+def load_jump_cache():
+    with open(jump_cache_filename, "rb") as f:
+        return pickle.load(f)
+
+# rebuilt by build_jump_cache.py.  only the /jump/temp endpoints read it, so it's loaded by the
+# first of those rather than at boot, and a rebuilt file gets picked up by the refresh thread
+jump_cache = register_dataset("jump_cache", load_jump_cache,
+                              version=lambda: files_version([jump_cache_filename]),
+                              lazy=True)
+
+
+# load the in-memory datasets off the request path, the worker is serving as soon as it is imported
+if os.getenv("WARM_UP_DATASETS", "True") == "True":
+    start_warm_up_thread()
+
+# and keep them fresh, swapping in new copies when their source changes
+if os.getenv("REFRESH_DATASETS", "True") == "True":
+    start_refresh_thread(int(os.getenv("DATASET_REFRESH_CHECK_SECONDS", 60)))
+
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5003))